@@ -19,6 +19,10 @@ else
     pip install Pillow-2.3.0-cp27-none-linux_x86_64.whl
     pip install PyYAML-3.10-cp27-none-linux_x86_64.whl
 
+    # concurrent.futures for the thread queue and the cleanup and sweep
+    # workers
+    pip install futures
+
 fi
 
 if [[ -z "$WHEEL" ]]; then
@@ -1,4 +1,4 @@
 from sorl.thumbnail.fields import ImageField
-from sorl.thumbnail.shortcuts import get_thumbnail, delete
+from sorl.thumbnail.shortcuts import get_thumbnail, get_thumbnails, prefetch_thumbnails, delete
 from sorl import __version__
 
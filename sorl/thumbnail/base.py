@@ -2,6 +2,13 @@ import logging
 
 import os
 import re
+import time
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
+
 from sorl.thumbnail.compat import string_type
 from sorl.thumbnail.conf import settings, defaults as default_settings
 from sorl.thumbnail.helpers import tokey, serialize
@@ -42,6 +49,18 @@ class ThumbnailBackend(object):
         ('blur', 'THUMBNAIL_BLUR'),
     )
 
+    # Seconds between key value store lookups when waiting for a thumbnail
+    # that is being created by another process
+    lock_poll_interval = 0.1
+
+    # Number of thumbnail filenames remembered, see ``_get_thumbnail_filename``
+    filename_cache_size = 10000
+
+    # Options derived from the settings, see ``_get_default_options``
+    _default_options = None
+    _preserve_format = None
+    _filenames = None
+
     def file_extension(self, file_):
         return os.path.splitext(file_.name)[1].lower()
 
@@ -65,68 +84,294 @@ class ThumbnailBackend(object):
         """
         logger.debug('Getting thumbnail for file [%s] at [%s]', file_,
                      geometry_string)
-        if file_:
-            source = ImageFile(file_)
-        elif settings.THUMBNAIL_DUMMY:
-            return DummyImageFile(geometry_string)
-        else:
-            return None
+        return self.get_thumbnails(file_, [(geometry_string, options)])[0]
 
-        #preserve image filetype
-        if settings.THUMBNAIL_PRESERVE_FORMAT:
-            options.setdefault('format', self._get_format(file_))
-
-        for key, value in self.default_options.items():
-            options.setdefault(key, value)
-
-
-        # For the future I think it is better to add options only if they
-        # differ from the default settings as below. This will ensure the same
-        # filenames being generated for new options at default.
-        for key, attr in self.extra_options:
-            value = getattr(settings, attr)
-            if value != getattr(default_settings, attr):
-                options.setdefault(key, value)
-        name = self._get_thumbnail_filename(source, geometry_string, options)
-        thumbnail = ImageFile(name, default.storage)
-        cached = default.kvstore.get(thumbnail)
-        if cached:
-            return cached
-        else:
-            # We have to check exists() because the Storage backend does not
-            # overwrite in some implementations.
-            # so we make the assumption that if the thumbnail is not cached, it doesn't exist
-            try:
-                source_image = default.engine.get_image(source)
-            except IOError:
-                if settings.THUMBNAIL_DUMMY:
-                    return DummyImageFile(geometry_string)
+    def get_thumbnails(self, file_, thumbnail_specs):
+        """
+        Returns a list of thumbnails as ImageFile instances for file and the
+        ``(geometry_string, options)`` pairs given, in the same order. Cached
+        thumbnails are taken from the key value store, all the others are
+        created from a single read and decode of the source image. When
+        ``THUMBNAIL_QUEUE`` is set they are queued for creation instead and
+        placeholders are returned for them.
+        """
+        return self._get_thumbnails(file_, thumbnail_specs,
+                                    queue=bool(settings.THUMBNAIL_QUEUE))
+
+    def create_thumbnails(self, file_, thumbnail_specs):
+        """
+        Same as ``get_thumbnails`` but always creates the missing thumbnails
+        right away, this is what queued jobs run.
+        """
+        return self._get_thumbnails(file_, thumbnail_specs, queue=False)
+
+    def _get_thumbnails(self, file_, thumbnail_specs, queue):
+        if not file_:
+            if settings.THUMBNAIL_DUMMY:
+                return [DummyImageFile(geometry_string)
+                        for geometry_string, options in thumbnail_specs]
+            return [None] * len(thumbnail_specs)
+
+        source = ImageFile(file_)
+        specs = []
+
+        for geometry_string, options in thumbnail_specs:
+            options = self._get_options(file_, options or {})
+            name = self._get_thumbnail_filename(source, geometry_string, options)
+            specs.append((ImageFile(name, default.storage), geometry_string, options))
+
+        thumbnails = []
+        missing = []
+        missing_names = set()
+        cached_thumbnails = default.kvstore.get_many([spec[0] for spec in specs])
+
+        for (thumbnail, geometry_string, options), cached in zip(specs, cached_thumbnails):
+            if cached:
+                thumbnails.append(cached)
+                continue
+            thumbnails.append(thumbnail)
+            # The same thumbnail may be asked for more than once
+            if thumbnail.name not in missing_names:
+                missing_names.add(thumbnail.name)
+                missing.append((thumbnail, geometry_string, options))
+
+        if not missing:
+            return thumbnails
+
+        # Sources that could not be read are not tried again until
+        # THUMBNAIL_BROKEN_TIMEOUT has passed.
+        if settings.THUMBNAIL_BROKEN_TIMEOUT and default.kvstore.is_broken(source):
+            created = self._get_broken_thumbnails(file_, missing)
+            return [created.get(thumbnail.name, thumbnail) for thumbnail in thumbnails]
+
+        if queue:
+            default.queue.enqueue(source, [(geometry_string, options)
+                                           for thumbnail, geometry_string, options in missing])
+            created = dict((thumbnail.name, DummyImageFile(geometry_string))
+                           for thumbnail, geometry_string, options in missing)
+            return [created.get(thumbnail.name, thumbnail) for thumbnail in thumbnails]
+
+        # Only one process at a time creates a thumbnail, the others wait for
+        # it to show up in the key value store.
+        locked = []
+        waiting = []
+        for thumbnail_spec in missing:
+            if default.lock.acquire(thumbnail_spec[0].key):
+                locked.append(thumbnail_spec)
+            else:
+                waiting.append(thumbnail_spec)
+
+        # The process that held a lock may have created the thumbnail and
+        # released the lock after the lookup above.
+        found = {}
+        if locked and default.lock.exclusive:
+            pending = []
+            cached_thumbnails = default.kvstore.get_many([spec[0] for spec in locked])
+            for thumbnail_spec, cached in zip(locked, cached_thumbnails):
+                if cached:
+                    found[cached.name] = cached
+                    default.lock.release(thumbnail_spec[0].key)
+                else:
+                    pending.append(thumbnail_spec)
+            locked = pending
+
+        try:
+            created = self._create_thumbnails(file_, source, locked)
+        finally:
+            for thumbnail, geometry_string, options in locked:
+                default.lock.release(thumbnail.key)
+        created.update(found)
+        created.update(self._wait_for_thumbnails(waiting))
+
+        return [created.get(thumbnail.name, thumbnail) for thumbnail in thumbnails]
+
+    def _create_thumbnails(self, file_, source, thumbnail_specs):
+        """
+        Creates the thumbnails for the ``(thumbnail, geometry_string,
+        options)`` specs given from a single read of the source. Returns a dict
+        of the results keyed by thumbnail name.
+        """
+        created = dict((thumbnail.name, thumbnail)
+                       for thumbnail, geometry_string, options in thumbnail_specs)
+        if not thumbnail_specs:
+            return created
+
+        # We have to check exists() because the Storage backend does not
+        # overwrite in some implementations.
+        # so we make the assumption that if the thumbnail is not cached, it doesn't exist
+        try:
+            source_image = default.engine.get_image(source)
+        except IOError:
+            # if S3Storage says file doesn't exist remotely, don't try to
+            # create it and exit early.
+            # Will return working empty image type; 404'd image
+            if settings.THUMBNAIL_BROKEN_TIMEOUT:
+                default.kvstore.set_broken(source)
+            return self._get_broken_thumbnails(file_, thumbnail_specs)
+
+        # We might as well set the size since we have the image in memory
+        image_info = default.engine.get_image_info(source_image)
+        size = default.engine.get_image_size(source_image)
+        source.set_size(size)
+        # The engine only needs to decode as much of the source as the
+        # largest thumbnail made from it, alternative resolutions included.
+        resolution = max([1] + list(settings.THUMBNAIL_ALTERNATIVE_RESOLUTIONS))
+        geometries = []
+        targets = []
+        for thumbnail, geometry_string, options in thumbnail_specs:
+            ratio = default.engine.get_image_ratio(source_image, options)
+            geometry = parse_geometry(geometry_string, ratio)
+            geometries.append(geometry)
+            targets.append(((geometry[0] * resolution, geometry[1] * resolution),
+                            options))
+        source_image = default.engine.draft(source_image, targets)
+        # The size of a draft is rounded, the thumbnails are planned from the
+        # size of the source so they don't depend on the draft.
+        source_size = None
+        if default.engine.get_image_size(source_image) != size:
+            source_size = size
+        try:
+            last = len(thumbnail_specs) - 1
+            for index, (thumbnail, geometry_string, options) in enumerate(thumbnail_specs):
+                geometry = geometries[index]
+                options['image_info'] = image_info
+                # Every thumbnail but the last one gets its own copy of the
+                # decoded source since some engines process images in place.
+                if index < last:
+                    image = default.engine.copy_image(source_image)
                 else:
-                    # if S3Storage says file doesn't exist remotely, don't try to
-                    # create it and exit early.
-                    # Will return working empty image type; 404'd image
-                    logger.warn('Remote file [%s] at [%s] does not exist', file_, geometry_string)
-                    return thumbnail
-
-            # We might as well set the size since we have the image in memory
-            image_info = default.engine.get_image_info(source_image)
-            options['image_info'] = image_info
-            size = default.engine.get_image_size(source_image)
-            source.set_size(size)
-            try:
-                self._create_thumbnail(source_image, geometry_string, options,
-                                       thumbnail)
-                self._create_alternative_resolutions(source_image, geometry_string,
-                                                     options, thumbnail.name)
-            finally:
-                default.engine.cleanup(source_image)
+                    image = source_image
+                if settings.THUMBNAIL_ALTERNATIVE_RESOLUTIONS:
+                    # The alternative resolutions are made from the same image
+                    self._create_thumbnail(default.engine.copy_image(image),
+                                           geometry_string, options, thumbnail,
+                                           geometry, source_size)
+                    self._create_alternative_resolutions(image, geometry_string,
+                                                         options, thumbnail.name,
+                                                         geometry, source_size)
+                else:
+                    self._create_thumbnail(image, geometry_string, options,
+                                           thumbnail, geometry, source_size)
+            default.engine.flush(source_image)
+        finally:
+            default.engine.cleanup(source_image)
 
         # If the thumbnail exists we don't create it, the other option is
         # to delete and write but this could lead to race conditions so I
         # will just leave that out for now.
         default.kvstore.get_or_set(source)
-        default.kvstore.set(thumbnail, source)
-        return thumbnail
+        for thumbnail, geometry_string, options in thumbnail_specs:
+            default.kvstore.set(thumbnail, source)
+        return created
+
+    def _get_broken_thumbnails(self, file_, thumbnail_specs):
+        """
+        Returns what to show for thumbnails of a source that can not be read,
+        keyed by thumbnail name.
+        """
+        broken = {}
+        for thumbnail, geometry_string, options in thumbnail_specs:
+            if settings.THUMBNAIL_DUMMY:
+                broken[thumbnail.name] = DummyImageFile(geometry_string)
+            else:
+                logger.warn('Remote file [%s] at [%s] does not exist', file_, geometry_string)
+                broken[thumbnail.name] = thumbnail
+        return broken
+
+    def _wait_for_thumbnails(self, thumbnail_specs):
+        """
+        Waits up to ``THUMBNAIL_LOCK_WAIT`` seconds for thumbnails created by
+        another process to show up in the key value store. Returns a dict of
+        them keyed by thumbnail name, with placeholders for the ones that did
+        not show up in time.
+        """
+        found = {}
+        deadline = time.time() + settings.THUMBNAIL_LOCK_WAIT
+
+        while thumbnail_specs:
+            cached_thumbnails = default.kvstore.get_many(
+                [spec[0] for spec in thumbnail_specs])
+            pending = []
+            for thumbnail_spec, cached in zip(thumbnail_specs, cached_thumbnails):
+                if cached:
+                    found[cached.name] = cached
+                else:
+                    pending.append(thumbnail_spec)
+            thumbnail_specs = pending
+            if not thumbnail_specs or time.time() >= deadline:
+                break
+            time.sleep(self.lock_poll_interval)
+
+        for thumbnail, geometry_string, options in thumbnail_specs:
+            logger.warn('Thumbnail [%s] is being created elsewhere', thumbnail.name)
+            found[thumbnail.name] = DummyImageFile(geometry_string)
+        return found
+
+    def prefetch_thumbnails(self, files, geometry_string, **options):
+        """
+        Gets the thumbnails of all files for geometry and options given from
+        the key value store in one go. Returns a dict of the thumbnails found,
+        keyed by name, see ``get_thumbnail_name``. With
+        ``THUMBNAIL_CONTENT_KEYS`` the content keys are set on the ``ImageFile``
+        instances among files.
+        """
+        files = [file_ for file_ in files if file_]
+        sources = [file_ if isinstance(file_, ImageFile) else ImageFile(file_)
+                   for file_ in files]
+        if settings.THUMBNAIL_CONTENT_KEYS:
+            # In one go rather than one by one in ``_get_source_key``
+            content_keys = default.kvstore.get_content_keys(sources)
+            for source, content_key in zip(sources, content_keys):
+                source.content_key = content_key
+        names = [self._get_thumbnail_filename(source, geometry_string,
+                                              self._get_options(file_, options))
+                 for file_, source in zip(files, sources)]
+        thumbnails = default.kvstore.get_many(
+            [ImageFile(name, default.storage) for name in names])
+        return dict((name, thumbnail)
+                    for name, thumbnail in zip(names, thumbnails) if thumbnail)
+
+    def get_thumbnail_name(self, file_, geometry_string, **options):
+        """
+        Returns the name of the thumbnail for file with geometry and options
+        given without looking it up or creating it. The content key of an
+        ``ImageFile`` is used if it is set.
+        """
+        options = self._get_options(file_, options)
+        source = file_ if isinstance(file_, ImageFile) else ImageFile(file_)
+        return self._get_thumbnail_filename(source, geometry_string, options)
+
+    def _get_options(self, file_, options):
+        """
+        Returns the options given with the default options for thumbnails of
+        file filled in.
+        """
+        filled = dict(self._get_default_options())
+        #preserve image filetype
+        if self._preserve_format:
+            filled['format'] = self._get_format(file_)
+        filled.update(options)
+        return filled
+
+    def _get_default_options(self):
+        """
+        Returns the default options for thumbnails, they are derived from the
+        settings once.
+        """
+        if self._default_options is None:
+            defaults = dict(self.default_options)
+
+            # For the future I think it is better to add options only if they
+            # differ from the default settings as below. This will ensure the
+            # same filenames being generated for new options at default.
+            for key, attr in self.extra_options:
+                value = getattr(settings, attr)
+                if value != getattr(default_settings, attr):
+                    defaults[key] = value
+
+            self._preserve_format = settings.THUMBNAIL_PRESERVE_FORMAT
+            self._default_options = defaults
+        return self._default_options
 
     def delete(self, file_, delete_file=True):
         """
@@ -139,58 +384,157 @@ class ThumbnailBackend(object):
         default.kvstore.delete(image_file)
 
     def _create_thumbnail(self, source_image, geometry_string, options,
-                          thumbnail):
+                          thumbnail, geometry=None, source_size=None):
         """
-        Creates the thumbnail by using default.engine
+        Creates the thumbnail by using default.engine. ``geometry`` is parsed
+        from ``geometry_string`` unless given, ``source_size`` is the size of
+        the source when ``source_image`` is a draft of it.
         """
         logger.debug('Creating thumbnail file [%s] at [%s] with [%s]',
                      thumbnail.name, geometry_string, options)
-        ratio = default.engine.get_image_ratio(source_image, options)
-        geometry = parse_geometry(geometry_string, ratio)
-        image = default.engine.create(source_image, geometry, options)
+        if geometry is None:
+            ratio = default.engine.get_image_ratio(source_image, options)
+            geometry = parse_geometry(geometry_string, ratio)
+        image = default.engine.create(source_image, geometry, options,
+                                      source_size=source_size)
         default.engine.write(image, options, thumbnail)
         # It's much cheaper to set the size here
         size = default.engine.get_image_size(image)
         thumbnail.set_size(size)
 
     def _create_alternative_resolutions(self, source_image, geometry_string,
-                                        options, name):
+                                        options, name, geometry=None,
+                                        source_size=None):
         """
         Creates the thumbnail by using default.engine with multiple output
-        sizes.  Appends @<ratio>x to the file name.
+        sizes.  Appends @<ratio>x to the file name. ``geometry`` and
+        ``source_size`` are the same as for ``_create_thumbnail``.
+
+        With engines that ``derive_resolutions`` only the largest resolution is
+        made from the source image, the others are scaled down from it. With
+        engines that allow ``parallel_writes`` they are written at the same
+        time.
         """
-        ratio = default.engine.get_image_ratio(source_image, options)
-        geometry = parse_geometry(geometry_string, ratio)
+        resolutions = sorted(settings.THUMBNAIL_ALTERNATIVE_RESOLUTIONS, reverse=True)
+        if not resolutions:
+            return
+        if geometry is None:
+            ratio = default.engine.get_image_ratio(source_image, options)
+            geometry = parse_geometry(geometry_string, ratio)
         file_name, dot_file_ext = os.path.splitext(name)
 
-        for resolution in settings.THUMBNAIL_ALTERNATIVE_RESOLUTIONS:
-            resolution_geometry = (int(geometry[0] * resolution), int(geometry[1] * resolution))
-            resolution_options = options.copy()
-            if 'crop' in options and isinstance(options['crop'], string_type):
-                crop = options['crop'].split(" ")
-                for i in range(len(crop)):
-                    s = re.match("(\d+)px", crop[i])
-                    if s:
-                        crop[i] = "%spx" % int(int(s.group(1)) * resolution)
-                resolution_options['crop'] = " ".join(crop)
-
-            image = default.engine.create(source_image, resolution_geometry, options)
+        if default.engine.derive_resolutions:
+            # Rounded corners, blur and padding are left to each resolution
+            render_options = self._get_resolution_options(options, resolutions[0])
+            render_options.update(rounded=None, blur=None, padding=False)
+            render = default.engine.create(
+                source_image, self._get_resolution_geometry(geometry, resolutions[0]),
+                render_options, source_size=source_size)
+
+            # The render is already cropped to the ratio of the thumbnail,
+            # cropping it again only takes off what rounding leaves over.
+            crop = options.get('crop')
+            if crop and crop != 'noop':
+                crop = 'center'
+            scale_options = dict(options, cropbox=None, orientation=False, crop=crop)
+
+        writes = []
+        for resolution in resolutions:
+            resolution_geometry = self._get_resolution_geometry(geometry, resolution)
+            resolution_options = self._get_resolution_options(options, resolution)
+            if default.engine.derive_resolutions:
+                image = default.engine.create(default.engine.copy_image(render),
+                                              resolution_geometry, scale_options)
+            else:
+                image = default.engine.create(default.engine.copy_image(source_image),
+                                              resolution_geometry, resolution_options,
+                                              source_size=source_size)
             thumbnail_name = '%(file_name)s%(suffix)s%(file_ext)s' % {
                 'file_name': file_name,
                 'suffix': '@%sx' % resolution,
                 'file_ext': dot_file_ext
             }
             thumbnail = ImageFile(thumbnail_name, default.storage)
-            default.engine.write(image, resolution_options, thumbnail)
-            size = default.engine.get_image_size(image)
-            thumbnail.set_size(size)
+            writes.append((image, resolution_options, thumbnail))
+
+        if (ThreadPoolExecutor is None or len(writes) == 1 or
+                not default.engine.parallel_writes):
+            for write in writes:
+                self._write_alternative_resolution(*write)
+            return
+        with ThreadPoolExecutor(len(writes)) as executor:
+            # list() raises the first exception of the writes, if any
+            list(executor.map(lambda write: self._write_alternative_resolution(*write),
+                              writes))
+
+    def _get_resolution_geometry(self, geometry, resolution):
+        return int(geometry[0] * resolution), int(geometry[1] * resolution)
+
+    def _get_resolution_options(self, options, resolution):
+        """
+        Returns the options for an alternative resolution, crop offsets in
+        pixels are multiplied by the resolution.
+        """
+        resolution_options = options.copy()
+        if 'crop' in options and isinstance(options['crop'], string_type):
+            crop = options['crop'].split(" ")
+            for i in range(len(crop)):
+                s = re.match("(\d+)px", crop[i])
+                if s:
+                    crop[i] = "%spx" % int(int(s.group(1)) * resolution)
+            resolution_options['crop'] = " ".join(crop)
+        return resolution_options
+
+    def _write_alternative_resolution(self, image, options, thumbnail):
+        default.engine.write(image, options, thumbnail)
+        size = default.engine.get_image_size(image)
+        thumbnail.set_size(size)
+
+    def _get_source_key(self, source):
+        """
+        Returns the key the thumbnail filenames of ``source`` are derived from,
+        the key of its contents with ``THUMBNAIL_CONTENT_KEYS``.
+        """
+        if not settings.THUMBNAIL_CONTENT_KEYS:
+            return source.key
+        if source.content_key is None:
+            source.content_key = default.kvstore.get_content_key(source)
+            if source.content_key is None:
+                # Can't be read, it gets the usual treatment of missing
+                # sources when its thumbnails are created.
+                return source.key
+        return source.content_key
 
     def _get_thumbnail_filename(self, source, geometry_string, options):
         """
         Computes the destination filename.
         """
-        key = tokey(source.key, geometry_string, serialize(options))
+        source_key = self._get_source_key(source)
+        # Serializing and hashing the options is most of the work of looking
+        # up a thumbnail, so recent filenames are remembered.
+        if self._filenames is None:
+            self._filenames = {}
+        try:
+            # With the types, values that are equal but serialize differently
+            # like 1 and True don't share a filename
+            cache_key = (source_key, geometry_string,
+                         tuple(sorted((key, type(value), value)
+                                      for key, value in options.items())))
+            return self._filenames[cache_key]
+        except KeyError:
+            pass
+        except TypeError:
+            # options that can't be hashed
+            cache_key = None
+
+        key = tokey(source_key, geometry_string, serialize(options))
         # make some subdirs
         path = '%s/%s/%s' % (key[:2], key[2:4], key)
-        return '%s%s.%s' % (settings.THUMBNAIL_PREFIX, path,
-                            EXTENSIONS[options['format']])
+        filename = '%s%s.%s' % (settings.THUMBNAIL_PREFIX, path,
+                                EXTENSIONS[options['format']])
+
+        if cache_key is not None:
+            if len(self._filenames) >= self.filename_cache_size:
+                self._filenames.clear()
+            self._filenames[cache_key] = filename
+        return filename
@@ -6,10 +6,12 @@ __all__ = [
     'json',
     'BufferIO',
     'urlopen',
+    'Request',
     'urlparse',
     'quote',
     'quote_plus',
     'URLError',
+    'HTTPError',
     'force_unicode', 'text_type'
 ]
 
@@ -29,8 +31,8 @@ else:
 # Python 2 and 3
 
 if PY3:
-    from urllib.error import URLError
-    from urllib.request import urlopen
+    from urllib.error import URLError, HTTPError
+    from urllib.request import urlopen, Request
     from urllib.parse import quote, quote_plus
 
     import urllib.parse as urlparse
@@ -49,8 +51,8 @@ if PY3:
         return urlparse.urlsplit(url.decode('ascii', 'ignore'))
 
 elif PY2:
-    from urllib2 import URLError
-    from urllib import urlopen
+    from urllib2 import URLError, HTTPError
+    from urllib2 import urlopen, Request
     from urllib import quote, quote_plus
 
     import urlparse
@@ -22,10 +22,61 @@ THUMBNAIL_KEY_DBCOLUMN = 'key'
 # convert is preferred but requires imagemagick or graphicsmagick, se docs
 THUMBNAIL_ENGINE = 'sorl.thumbnail.engines.pil_engine.Engine'
 
+# Lock making sure a thumbnail is only created by one process at a time, ships
+# with:
+# sorl.thumbnail.locks.base.DummyLock (no locking)
+# sorl.thumbnail.locks.cache_lock.Lock
+# sorl.thumbnail.locks.redis_lock.Lock
+# sorl.thumbnail.locks.file_lock.Lock
+THUMBNAIL_LOCK = 'sorl.thumbnail.locks.base.DummyLock'
+
+# Seconds after which a lock that was never released expires
+THUMBNAIL_LOCK_TIMEOUT = 60
+
+# Seconds to wait for a thumbnail that is being created by another process
+# before returning a placeholder instead
+THUMBNAIL_LOCK_WAIT = 5
+
+# Directory for the lock files of the file lock, ``None`` for the system
+# temporary directory
+THUMBNAIL_LOCK_DIR = None
+
+# Queue creating missing thumbnails outside of the request, a placeholder is
+# returned until they are ready. ``None`` creates them right away. Ships with:
+# sorl.thumbnail.queues.thread_queue.Queue
+THUMBNAIL_QUEUE = None
+
+# Number of threads of the thread queue
+THUMBNAIL_QUEUE_WORKERS = 4
+
+# Keeps the source images of remote storages around locally, ``None`` reads
+# them from the storage every time. Ships with:
+# sorl.thumbnail.source_cache.DiskCache
+THUMBNAIL_SOURCE_CACHE = None
+
+# Directory of the disk source cache, ``None`` uses a directory in the
+# system's temporary directory
+THUMBNAIL_SOURCE_CACHE_DIR = None
+
+# Size, in bytes, the disk source cache is kept under
+THUMBNAIL_SOURCE_CACHE_SIZE = 512 * 1024 * 1024
+
 # Path to Imagemagick or Graphicsmagick ``convert`` and ``identify``.
 THUMBNAIL_CONVERT = 'convert'
 THUMBNAIL_IDENTIFY = 'identify'
 
+# Keep a ``gm batch`` process running per thread and feed it the convert and
+# identify commands instead of starting a process for each. GraphicsMagick only.
+THUMBNAIL_CONVERT_BATCH = False
+
+# Create all thumbnails of a source with a single convert call that writes
+# each of them with ``-write``. ImageMagick only.
+THUMBNAIL_CONVERT_CHAIN = False
+
+# Feed the source to convert and identify on stdin and read the thumbnail
+# from stdout instead of going through temporary files
+THUMBNAIL_CONVERT_PIPE = False
+
 # Storage for the generated thumbnails
 THUMBNAIL_STORAGE = settings.DEFAULT_FILE_STORAGE
 
@@ -35,6 +86,8 @@ THUMBNAIL_REDIS_PASSWORD = ''
 THUMBNAIL_REDIS_HOST = 'localhost'
 THUMBNAIL_REDIS_PORT = 6379
 THUMBNAIL_REDIS_UNIX_SOCKET_PATH = None
+# Number of keys the Redis server looks at per SCAN call when iterating keys
+THUMBNAIL_REDIS_SCAN_COUNT = 1000
 
 # Cache timeout for ``cached_db`` store. You should probably keep this at
 # maximum or ``0`` if your caching backend can handle that as infinate.
@@ -46,9 +99,28 @@ THUMBNAIL_CACHE = 'default'
 # Key prefix used by the key value store
 THUMBNAIL_KEY_PREFIX = 'sorl-thumbnail'
 
+# hashlib algorithm keys and thumbnail filenames are computed with, and the
+# digest size in bytes for algorithms that take one like blake2b
+THUMBNAIL_KEY_HASH = 'md5'
+THUMBNAIL_KEY_DIGEST_SIZE = None
+
+# Maximum number of keys handled at once by bulk key value store operations
+THUMBNAIL_KVSTORE_CHUNK_SIZE = 1000
+
+# Key value store the ``tiered`` store keeps image files in, the ``tiered``
+# store keeps up to THUMBNAIL_TIERED_SIZE of them in memory for at most
+# THUMBNAIL_TIERED_TIMEOUT seconds, ``None`` meaning no limit.
+THUMBNAIL_TIERED_KVSTORE = 'sorl.thumbnail.kvstores.cached_db_kvstore.KVStore'
+THUMBNAIL_TIERED_SIZE = 10000
+THUMBNAIL_TIERED_TIMEOUT = None
+
 # Thumbnail filename prefix
 THUMBNAIL_PREFIX = 'cache/'
 
+# Derive thumbnail filenames from the contents of the source instead of its
+# name, so sources with the same contents share their thumbnails
+THUMBNAIL_CONTENT_KEYS = False
+
 # Image format, common formats are: JPEG, PNG
 # Make sure the backend can handle the format you specify
 THUMBNAIL_FORMAT = 'JPEG'
@@ -96,12 +168,23 @@ THUMBNAIL_DUMMY_RATIO = 1.5
 # We don't create retina images by default to optimize performance.
 THUMBNAIL_ALTERNATIVE_RESOLUTIONS = []
 
+# Seconds to remember that a source image could not be read and not try
+# again, ``None`` always tries.
+THUMBNAIL_BROKEN_TIMEOUT = None
+
 # Lazy fill empty thumbnail like THUMBNAIL_DUMMY
 THUMBNAIL_LAZY_FILL_EMPTY = False
 
 # Timeout, in seconds, to use when retrieving images with urllib2
 THUMBNAIL_URL_TIMEOUT = None
 
+# Timeout, in seconds, to connect when retrieving images, defaults to
+# THUMBNAIL_URL_TIMEOUT
+THUMBNAIL_URL_CONNECT_TIMEOUT = None
+
+# Keep-alive connections kept per host when urllib3 is installed
+THUMBNAIL_URL_POOL_SIZE = 10
+
 # Default width when using filters for texts
 THUMBNAIL_FILTER_WIDTH = 500
 
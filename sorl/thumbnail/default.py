@@ -18,6 +18,21 @@ class Engine(LazyObject):
         self._wrapped = get_module_class(settings.THUMBNAIL_ENGINE)()
 
 
+class Lock(LazyObject):
+    def _setup(self):
+        self._wrapped = get_module_class(settings.THUMBNAIL_LOCK)()
+
+
+class Queue(LazyObject):
+    def _setup(self):
+        self._wrapped = get_module_class(settings.THUMBNAIL_QUEUE)()
+
+
+class SourceCache(LazyObject):
+    def _setup(self):
+        self._wrapped = get_module_class(settings.THUMBNAIL_SOURCE_CACHE)()
+
+
 class Storage(LazyObject):
     def _setup(self):
         self._wrapped = get_module_class(settings.THUMBNAIL_STORAGE)()
@@ -26,4 +41,7 @@ class Storage(LazyObject):
 backend = Backend()
 kvstore = KVStore()
 engine = Engine()
+lock = Lock()
+queue = Queue()
+source_cache = SourceCache()
 storage = Storage()
@@ -5,25 +5,125 @@ from sorl.thumbnail.parsers import parse_crop
 from sorl.thumbnail.parsers import parse_cropbox
 
 
+# Exif orientations that swap the width and height of the image
+TRANSPOSING_ORIENTATIONS = (5, 6, 7, 8)
+
+
 class EngineBase(object):
     """
     ABC for Thumbnail engines, methods are static
     """
 
-    def create(self, image, geometry, options):
+    # Engines that implement ``_get_orientation`` and ``_transpose`` can orient
+    # the image after it has been scaled down.
+    defer_orientation = False
+
+    # Engines that implement ``_scale_box`` can scale just the part of the
+    # image that is left after cropping.
+    fuse_crop = False
+
+    # Engines whose images hold pixels, rather than describe how to make them
+    # from the source, can make smaller alternative resolutions by scaling
+    # down the largest one.
+    derive_resolutions = False
+
+    # Whether images can be written from more than one thread at a time
+    parallel_writes = True
+
+    def create(self, image, geometry, options, source_size=None):
         """
-        Processing conductor, returns the thumbnail as an image engine instance
+        Processing conductor, returns the thumbnail as an image engine instance.
+        The size of the thumbnail is planned up front so orienting, converting
+        and cropping can be done on as few pixels as possible, see ``plan``.
+        ``source_size`` is the size of the source when ``image`` is a draft of
+        it, see ``draft``.
         """
         image = self.cropbox(image, geometry, options)
-        image = self.orientation(image, geometry, options)
-        image = self.colorspace(image, geometry, options)
-        image = self.scale(image, geometry, options)
-        image = self.crop(image, geometry, options)
+
+        orientation = None
+        if self.defer_orientation and options.get('orientation', settings.THUMBNAIL_ORIENTATION):
+            orientation = self._get_orientation(image)
+        if orientation in (None, 1) or not self._can_defer_orientation(image, orientation):
+            if source_size and orientation in TRANSPOSING_ORIENTATIONS:
+                source_size = source_size[1], source_size[0]
+            orientation = None
+            image = self.orientation(image, geometry, options)
+
+        defer_colorspace = self._can_defer_colorspace(image, options['colorspace'])
+        if not defer_colorspace:
+            image = self.colorspace(image, geometry, options)
+
+        plan = self.plan(image, geometry, options,
+                         transposed=orientation in TRANSPOSING_ORIENTATIONS,
+                         source_size=source_size)
+        if self.fuse_crop and orientation is None and plan['box']:
+            image = self._scale_box(image, plan['crop'][0], plan['crop'][1], plan['box'])
+        else:
+            if plan['scale']:
+                image = self._scale(image, *plan['scale'])
+            if orientation is not None:
+                image = self._transpose(image, orientation)
+            if plan['crop']:
+                image = self._crop(image, *plan['crop'])
+
+        if defer_colorspace:
+            image = self.colorspace(image, geometry, options)
         image = self.rounded(image, geometry, options)
         image = self.blur(image, geometry, options)
         image = self.padding(image, geometry, options)
         return image
 
+    def plan(self, image, geometry, options, transposed=False, source_size=None):
+        """
+        Works out what ``scale`` and ``crop`` would do to the image, without
+        touching it. ``transposed`` tells that width and height of the image
+        are swapped by orienting it later. When the image is a draft the sizes
+        are worked out from the ``source_size``, the ratio of a draft may be a
+        little off. Returns a dict with:
+
+        * ``scale``: the ``(width, height)`` to scale the image to, or ``None``
+        * ``crop``: the ``(width, height, x_offset, y_offset)`` to crop the
+          scaled and oriented image to, or ``None``
+        * ``box``: the ``(left, top, right, bottom)`` of the source image that
+          ends up in the thumbnail when it is both scaled and cropped, or
+          ``None``
+        """
+        x_image, y_image = self.get_image_size(image)
+        x_source, y_source = source_size or (x_image, y_image)
+        if transposed:
+            x_image, y_image = y_image, x_image
+            x_source, y_source = y_source, x_source
+
+        # Same as ``scale``
+        factor = self._calculate_scaling_factor(
+            float(x_source), float(y_source), geometry, options)
+        x_scaled, y_scaled = x_image, y_image
+        if factor < 1 or options['upscale']:
+            x_scaled, y_scaled = toint(x_source * factor), toint(y_source * factor)
+        scale = None
+        if (x_scaled, y_scaled) != (x_image, y_image):
+            scale = (y_scaled, x_scaled) if transposed else (x_scaled, y_scaled)
+
+        # Same as ``crop`` on the scaled image
+        crop = options['crop']
+        factor = self._calculate_scaling_factor(x_scaled, y_scaled, geometry, options)
+        cropped = None
+        if crop and crop != 'noop' and (options['upscale'] or factor < 1):
+            width, height = min(x_scaled, geometry[0]), min(y_scaled, geometry[1])
+            x_offset, y_offset = parse_crop(crop, (x_scaled, y_scaled), (width, height))
+            if (width, height, x_offset, y_offset) != (x_scaled, y_scaled, 0, 0):
+                cropped = (width, height, x_offset, y_offset)
+
+        box = None
+        if scale and cropped and not transposed:
+            x_factor = float(x_scaled) / x_image
+            y_factor = float(y_scaled) / y_image
+            width, height, x_offset, y_offset = cropped
+            box = (x_offset / x_factor, y_offset / y_factor,
+                   (x_offset + width) / x_factor, (y_offset + height) / y_factor)
+
+        return {'scale': scale, 'crop': cropped, 'box': box}
+
     def cropbox(self, image, geometry, options):
         """
         Wrapper for ``_cropbox``
@@ -127,10 +227,34 @@ class EngineBase(object):
         )
         thumbnail.write(raw_data)
 
+    def flush(self, image):
+        """
+        Called once all thumbnails of the source image have been created and
+        written, for engines that defer writing them
+        """
+        pass
+
     def cleanup(self, image):
         """Some backends need to manually cleanup after thumbnails are created"""
         pass
 
+    def copy_image(self, image):
+        """
+        Returns a copy of the image that can be processed without affecting
+        the original. Engines that process images in place need to override
+        this.
+        """
+        return image
+
+    def draft(self, image, targets):
+        """
+        Called with the ``(geometry, options)`` pairs the image is going to be
+        processed for before any of them is created. Engines that can decode
+        the source at a reduced size may do so here as long as the result is
+        still large enough for all of them. Returns the image.
+        """
+        return image
+
     def get_image_ratio(self, image, options):
         """
         Calculates the image ratio. If cropbox option is used, the ratio
@@ -173,12 +297,41 @@ class EngineBase(object):
         """
         raise NotImplemented()
 
+    def _get_orientation(self, image):
+        """
+        Returns the exif orientation of the image, ``None`` if it has none
+        """
+        return None
+
     def _orientation(self, image):
         """
         Read orientation exif data and orientate the image accordingly
         """
         return image
 
+    def _can_defer_orientation(self, image, orientation):
+        """
+        Whether orienting the image after scaling it gives the same result as
+        before. Turning it by 90 degrees swaps the order width and height are
+        resampled in, which rounds differently.
+        """
+        return orientation not in TRANSPOSING_ORIENTATIONS
+
+    def _transpose(self, image, orientation):
+        """
+        Orientates the image by the exif orientation given, for engines with
+        ``defer_orientation``
+        """
+        raise NotImplemented()
+
+    def _can_defer_colorspace(self, image, colorspace):
+        """
+        Whether converting the image to ``colorspace`` after scaling it gives
+        the same result as before, engines doing more work when the image is
+        converted first should say so.
+        """
+        return False
+
     def _colorspace(self, image, colorspace):
         """
         `Valid colorspaces
@@ -201,6 +354,13 @@ class EngineBase(object):
         """
         raise NotImplemented()
 
+    def _scale_box(self, image, width, height, box):
+        """
+        Scales the ``(left, top, right, bottom)`` box of the image to width and
+        height, for engines with ``fuse_crop``
+        """
+        raise NotImplemented()
+
     def _get_raw_data(self, image, format_, quality, image_info=None, progressive=False):
         """
         Gets raw data given the image, format and quality. This method is
@@ -4,10 +4,13 @@ import re
 import os
 
 import subprocess
+import threading
 
+from django.core.exceptions import ImproperlyConfigured
 from django.utils.datastructures import SortedDict
 from django.utils.encoding import smart_str
 from sorl.thumbnail.base import EXTENSIONS
+from sorl.thumbnail.compat import encode, force_unicode
 from sorl.thumbnail.conf import settings
 from sorl.thumbnail.engines.base import EngineBase
 
@@ -15,6 +18,57 @@ from tempfile import NamedTemporaryFile
 
 
 size_re = re.compile(r'^(?:.+) (?:[A-Z]+) (?P<x>\d+)x(?P<y>\d+)')
+escape_re = re.compile(r'([\\\s"\'])')
+
+# The gm batch process of each thread
+local = threading.local()
+
+
+def escape(arg):
+    """
+    Escapes an argument for the unix escape format of ``gm batch``
+    """
+    return escape_re.sub(r'\\\1', force_unicode(arg))
+
+
+class Batch(object):
+    """
+    A long running ``gm batch`` process that commands are fed to one at a time,
+    it answers each of them with a line telling whether it succeeded.
+    """
+    pass_text = 'SORL-THUMBNAIL-PASS'
+    fail_text = 'SORL-THUMBNAIL-FAIL'
+
+    def __init__(self, args):
+        args = args + ['-escape', 'unix', '-feedback', 'on', '-prompt', 'off',
+                       '-pass', self.pass_text, '-fail', self.fail_text, '-']
+        self.process = subprocess.Popen([smart_str(arg) for arg in args],
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT)
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def run(self, args):
+        """
+        Runs a gm command, without the leading ``gm``, and returns whether it
+        succeeded and its output
+        """
+        line = ' '.join(escape(arg) for arg in args)
+        self.process.stdin.write(encode(line) + b'\n')
+        self.process.stdin.flush()
+        output = []
+        while True:
+            result = self.process.stdout.readline()
+            if not result:
+                raise IOError('gm batch exited unexpectedly')
+            result = result.rstrip(b'\r\n')
+            if result == encode(self.pass_text):
+                return True, b'\n'.join(output)
+            if result == encode(self.fail_text):
+                return False, b'\n'.join(output)
+            output.append(result)
 
 
 class Engine(EngineBase):
@@ -22,6 +76,12 @@ class Engine(EngineBase):
     Image object is a dict with source path, options and size
     """
 
+    @property
+    def parallel_writes(self):
+        # Each thread starts its own gm batch process, and chained writes
+        # are only collected until ``flush``
+        return not (settings.THUMBNAIL_CONVERT_BATCH or settings.THUMBNAIL_CONVERT_CHAIN)
+
     def write(self, image, options, thumbnail):
         """
         Writes the thumbnail image
@@ -30,9 +90,73 @@ class Engine(EngineBase):
             image['options']['interlace'] = 'line'
         image['options']['quality'] = options['quality']
 
-        args = settings.THUMBNAIL_CONVERT.split(' ')
-        args.append(image['source'] + '[0]')
+        args = self._get_args(image, options)
+        suffix = '.%s' % EXTENSIONS[options['format']]
 
+        if image['writes'] is not None:
+            # Written together with the other thumbnails of the source in
+            # ``flush``
+            image['writes'].append((args, suffix, thumbnail))
+            return
+
+        args = [image['source'] + '[0]'] + args
+        if image['data'] is not None:
+            # Read the thumbnail from stdout
+            args.append('%s:-' % EXTENSIONS[options['format']])
+            retcode, out, err = self._run(settings.THUMBNAIL_CONVERT, args,
+                                          input=image['data'])
+            if err:
+                raise Exception(err)
+
+            thumbnail.write(out)
+            return
+
+        with NamedTemporaryFile(suffix=suffix, mode='rb') as fp:
+            args.append(fp.name)
+            retcode, out, err = self._run(settings.THUMBNAIL_CONVERT, args)
+
+            if err:
+                raise Exception(err)
+
+            thumbnail.write(fp.read())
+
+    def flush(self, image):
+        """
+        Runs the writes deferred by ``THUMBNAIL_CONVERT_CHAIN`` in a single
+        convert call, each thumbnail is processed from a clone of the source
+        in parentheses and saved with ``-write``.
+        """
+        writes = image['writes']
+        if not writes:
+            return
+
+        args = ['-respect-parentheses', image['source'] + '[0]']
+        files = []
+        try:
+            for write_args, suffix, thumbnail in writes:
+                fp = NamedTemporaryFile(suffix=suffix, mode='rb')
+                files.append(fp)
+                args.extend(['(', '+clone'] + write_args +
+                            ['-write', fp.name, '+delete', ')'])
+            args.append('null:')
+            retcode, out, err = self._run(settings.THUMBNAIL_CONVERT, args,
+                                          input=image['data'])
+
+            if err:
+                raise Exception(err)
+
+            for fp, (write_args, suffix, thumbnail) in zip(files, writes):
+                thumbnail.write(fp.read())
+        finally:
+            del writes[:]
+            for fp in files:
+                fp.close()
+
+    def _get_args(self, image, options):
+        """
+        Returns the convert arguments that turn the source into the thumbnail
+        """
+        args = []
         for k in image['options']:
             v = image['options'][k]
             args.append('-%s' % k)
@@ -46,68 +170,133 @@ class Engine(EngineBase):
         if settings.THUMBNAIL_FLATTEN and not flatten == "off":
             args.append('-flatten')
 
-        suffix = '.%s' % EXTENSIONS[options['format']]
+        return args
 
-        with NamedTemporaryFile(suffix=suffix, mode='rb') as fp:
-            args.append(fp.name)
-            args = map(smart_str, args)
-            p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            p.wait()
-            out, err = p.communicate()
+    def _run(self, command, args, input=None):
+        """
+        Runs the ``THUMBNAIL_CONVERT`` or ``THUMBNAIL_IDENTIFY`` command given
+        with the arguments given, feeding it input on stdin. Returns its return
+        code, output and errors.
+        """
+        command = command.split(' ')
+        if settings.THUMBNAIL_CONVERT_BATCH:
+            succeeded, out = self._get_batch().run(command[-1:] + args)
+            if succeeded:
+                return 0, out, b''
+            return 1, b'', out or b'gm batch command failed'
 
-            if err:
-                raise Exception(err)
+        args = [smart_str(arg) for arg in command + args]
+        p = subprocess.Popen(args, stdin=subprocess.PIPE if input is not None else None,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        # communicate() reads stdout and stderr while writing the input, a
+        # wait() first would block once either of the pipes fills up
+        out, err = p.communicate(input)
+        return p.returncode, out, err
 
-            thumbnail.write(fp.read())
+    def _use_pipes(self):
+        # The stdin and stdout of gm batch carry its commands
+        return settings.THUMBNAIL_CONVERT_PIPE and not settings.THUMBNAIL_CONVERT_BATCH
+
+    def _get_batch(self):
+        """
+        Returns the ``gm batch`` process of the current thread, starting it if
+        needed
+        """
+        batch = getattr(local, 'batch', None)
+        if batch is None or not batch.is_alive():
+            if not self._is_graphicsmagick():
+                raise ImproperlyConfigured(
+                    'THUMBNAIL_CONVERT_BATCH needs THUMBNAIL_CONVERT to be '
+                    'GraphicsMagick\'s "gm convert".')
+            batch = local.batch = Batch(
+                settings.THUMBNAIL_CONVERT.split(' ')[:-1] + ['batch'])
+        return batch
+
+    def _is_graphicsmagick(self):
+        return settings.THUMBNAIL_CONVERT.endswith('gm convert')
 
     def cleanup(self, image):
-        os.remove(image['source'])  # we should not need this now
+        if image['writes']:
+            del image['writes'][:]
+        if image['data'] is None:
+            os.remove(image['source'])  # we should not need this now
+
+    def copy_image(self, image):
+        """
+        The copy shares the source file but has its own options
+        """
+        copy = image.copy()
+        copy['options'] = image['options'].copy()
+        return copy
 
     def get_image(self, source):
         """
         Returns the backend image objects from a ImageFile instance
         """
-        with NamedTemporaryFile(mode='wb', delete=False) as fp:
-            fp.write(source.read())
-        return {'source': fp.name, 'options': SortedDict(), 'size': None}
+        if self._use_pipes():
+            # Fed to the commands on stdin
+            name, data = '-', source.read()
+        else:
+            with NamedTemporaryFile(mode='wb', delete=False) as fp:
+                fp.write(source.read())
+            name, data = fp.name, None
+        # Copies share the list of deferred writes
+        writes = [] if settings.THUMBNAIL_CONVERT_CHAIN else None
+        return {'source': name, 'data': data, 'options': SortedDict(),
+                'size': None, 'writes': writes}
 
     def get_image_size(self, image):
         """
         Returns the image width and height as a tuple
         """
         if image['size'] is None:
-            args = settings.THUMBNAIL_IDENTIFY.split(' ')
-            args.append(image['source'])
-            p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            p.wait()
-            m = size_re.match(str(p.stdout.read()))
-            image['size'] = int(m.group('x')), int(m.group('y'))
+            if self._is_graphicsmagick():
+                self._identify(image)
+            else:
+                retcode, out, err = self._run(settings.THUMBNAIL_IDENTIFY,
+                                              [image['source']],
+                                              input=image['data'])
+                m = size_re.match(force_unicode(out))
+                image['size'] = int(m.group('x')), int(m.group('y'))
         return image['size']
 
+    def _identify(self, image):
+        """
+        Reads the size and exif orientation of the source with a single
+        GraphicsMagick identify call
+        """
+        args = ['-format', '%w %h %[exif:orientation]', image['source']]
+        retcode, out, err = self._run(settings.THUMBNAIL_IDENTIFY, args,
+                                      input=image['data'])
+        values = force_unicode(out).splitlines()[0].split()
+        if image['size'] is None:
+            image['size'] = int(values[0]), int(values[1])
+        image['orientation'] = values[2] if len(values) > 2 else None
+
     def is_valid_image(self, raw_data):
         """
         This is not very good for imagemagick because it will say anything is
         valid that it can use as input.
         """
+        if self._use_pipes():
+            retcode, out, err = self._run(settings.THUMBNAIL_IDENTIFY, ['-'],
+                                          input=raw_data)
+            return retcode == 0
+
         with NamedTemporaryFile(mode='wb') as fp:
             fp.write(raw_data)
             fp.flush()
-            args = settings.THUMBNAIL_IDENTIFY.split(' ')
-            args.append(fp.name)
-            p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            retcode = p.wait()
+            retcode, out, err = self._run(settings.THUMBNAIL_IDENTIFY, [fp.name])
         return retcode == 0
 
     def _orientation(self, image):
         #return image
         # XXX need to get the dimensions right after a transpose.
 
-        if settings.THUMBNAIL_CONVERT.endswith('gm convert'):
-            args = settings.THUMBNAIL_IDENTIFY.split()
-            args.extend(['-format', '%[exif:orientation]', image['source']])
-            p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            p.wait()
-            result = p.stdout.read().strip()
+        if self._is_graphicsmagick():
+            if 'orientation' not in image:
+                self._identify(image)
+            result = image['orientation']
             if result and result != 'unknown':
                 result = int(result)
                 options = image['options']
@@ -17,6 +17,9 @@ class Engine(EngineBase):
         blob.update(source.read())
         return Image(blob)
 
+    def copy_image(self, image):
+        return Image(image)
+
     def get_image_size(self, image):
         geometry = image.size()
         return geometry.width(), geometry.height()
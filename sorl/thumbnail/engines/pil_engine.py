@@ -1,3 +1,6 @@
+import math
+
+from sorl.thumbnail.conf import settings
 from sorl.thumbnail.engines.base import EngineBase
 from sorl.thumbnail.compat import BufferIO
 
@@ -6,6 +9,32 @@ try:
 except ImportError:
     import Image, ImageFile, ImageDraw, ImageChops
 
+# Pillow 7.0+ can shrink by an integer factor before resampling which is a lot
+# faster than resampling the full image and looks the same.
+if hasattr(Image.Image, 'reduce'):
+    RESIZE_OPTIONS = {'reducing_gap': 3.0}
+else:
+    RESIZE_OPTIONS = {}
+
+# Pillow 3.4+ can resample just a part of the image, which saves cropping it
+# after scaling.
+try:
+    Image.new('L', (2, 2)).resize((1, 1), box=(0, 0, 1, 1))
+    RESIZE_BOX = True
+except TypeError:
+    RESIZE_BOX = False
+
+# Transpositions that orientate an image by its exif orientation
+TRANSPOSITIONS = {
+    2: (Image.FLIP_LEFT_RIGHT,),
+    3: (Image.ROTATE_180,),
+    4: (Image.FLIP_TOP_BOTTOM,),
+    5: (Image.ROTATE_270, Image.FLIP_LEFT_RIGHT),
+    6: (Image.ROTATE_270,),
+    7: (Image.ROTATE_90, Image.FLIP_LEFT_RIGHT),
+    8: (Image.ROTATE_90,),
+}
+
 
 def round_corner(radius, fill):
     """Draw a round corner"""
@@ -39,6 +68,13 @@ class GaussianBlur(ImageFilter.Filter):
 
 
 class Engine(EngineBase):
+    # Drafts are decoded at least this many times larger than the thumbnail
+    # so the final resampling still has pixels to work with.
+    draft_gap = 2.0
+    defer_orientation = True
+    fuse_crop = RESIZE_BOX
+    derive_resolutions = True
+
     def get_image(self, source):
         buffer = BufferIO(source.read())
         return Image.open(buffer)
@@ -49,6 +85,32 @@ class Engine(EngineBase):
     def get_image_info(self, image):
         return image.info or {}
 
+    def draft(self, image, targets):
+        # JPEGs can be decoded at 1/2, 1/4 or 1/8 of their size, but only
+        # before they are loaded and only the full image.
+        if image.format != 'JPEG' or image.im is not None:
+            return image
+        x_image, y_image = map(float, self.get_image_size(image))
+        transposed = self._get_orientation(image) in (5, 6, 7, 8)
+
+        factor = 0
+        for geometry, options in targets:
+            if options.get('cropbox'):
+                return image
+            if transposed and options.get('orientation', settings.THUMBNAIL_ORIENTATION):
+                size = y_image, x_image
+            else:
+                size = x_image, y_image
+            factor = max(factor, self._calculate_scaling_factor(
+                size[0], size[1], geometry, options))
+        factor *= self.draft_gap
+        if not targets or factor > 0.5:
+            return image
+
+        image.draft(image.mode, (int(math.ceil(x_image * factor)),
+                                 int(math.ceil(y_image * factor))))
+        return image
+
     def is_valid_image(self, raw_data):
         buffer = BufferIO(raw_data)
         try:
@@ -61,32 +123,34 @@ class Engine(EngineBase):
     def _cropbox(self, image, x, y, x2, y2):
         return image.crop((x, y, x2, y2))
 
-    def _orientation(self, image):
+    def _get_orientation(self, image):
         try:
             exif = image._getexif()
         except (AttributeError, IOError, KeyError, IndexError):
             exif = None
 
         if exif:
-            orientation = exif.get(0x0112)
-
-            if orientation == 2:
-                image = image.transpose(Image.FLIP_LEFT_RIGHT)
-            elif orientation == 3:
-                image = image.rotate(180)
-            elif orientation == 4:
-                image = image.transpose(Image.FLIP_TOP_BOTTOM)
-            elif orientation == 5:
-                image = image.rotate(-90).transpose(Image.FLIP_LEFT_RIGHT)
-            elif orientation == 6:
-                image = image.rotate(-90)
-            elif orientation == 7:
-                image = image.rotate(90).transpose(Image.FLIP_LEFT_RIGHT)
-            elif orientation == 8:
-                image = image.rotate(90)
+            return exif.get(0x0112)
+
+    def _orientation(self, image):
+        return self._transpose(image, self._get_orientation(image))
 
+    def _transpose(self, image, orientation):
+        # Transposing keeps all pixels, rotating a non square image by 90
+        # degrees would cut it to its old size.
+        for method in TRANSPOSITIONS.get(orientation, ()):
+            image = image.transpose(method)
         return image
 
+    def _can_defer_colorspace(self, image, colorspace):
+        # Scaling a grayscale image and converting it to RGB gives the same
+        # pixels as the other way round, on a third of the data.
+        if colorspace == 'RGB':
+            return image.mode in ('RGB', 'L')
+        if colorspace == 'GRAY':
+            return image.mode == 'L'
+        return False
+
     def _colorspace(self, image, colorspace):
         if colorspace == 'RGB':
             if image.mode == 'RGBA':
@@ -99,7 +163,12 @@ class Engine(EngineBase):
         return image
 
     def _scale(self, image, width, height):
-        return image.resize((width, height), resample=Image.ANTIALIAS)
+        return image.resize((width, height), resample=Image.ANTIALIAS,
+                            **RESIZE_OPTIONS)
+
+    def _scale_box(self, image, width, height, box):
+        return image.resize((width, height), resample=Image.ANTIALIAS, box=box,
+                            **RESIZE_OPTIONS)
 
     def _crop(self, image, width, height, x_offset, y_offset):
         return image.crop((x_offset, y_offset,
@@ -107,6 +176,8 @@ class Engine(EngineBase):
 
     def _rounded(self, image, r):
         i = round_rectangle(image.size, r, "notusedblack")
+        # putalpha works in place, don't touch the source image
+        image = image.copy()
         image.putalpha(i)
         return image
 
@@ -0,0 +1,172 @@
+'''
+libvips engine for Sorl-thumbnail, needs pyvips
+
+libvips processes images as a pipeline that is only evaluated, in small
+regions, when the thumbnail is written. Together with shrink-on-load this
+keeps both time and memory low on large sources.
+'''
+
+import pyvips
+from sorl.thumbnail.conf import settings
+from sorl.thumbnail.engines.base import EngineBase
+
+
+SUFFIXES = {
+    'JPEG': '.jpg',
+    'PNG': '.png',
+    'GIF': '.gif',
+    'WEBP': '.webp',
+}
+
+
+def parse_color(color, bands):
+    """
+    Turns a ``#rrggbb`` (or ``#rgb``) color into a list of band values for an
+    image with the number of bands given
+    """
+    color = color.lstrip('#')
+    if len(color) in (3, 4):
+        color = ''.join(c * 2 for c in color)
+    values = [int(color[i:i + 2], 16) for i in range(0, len(color), 2)]
+    alpha = values[3:] or [255]
+    values = values[:3]
+    if bands < 3:
+        values = [sum(values) // len(values)]
+    if bands % 2 == 0:
+        values += alpha
+    return values
+
+
+class Engine(EngineBase):
+    # Drafts are decoded at least this many times larger than the thumbnail
+    # so the final resampling still has pixels to work with.
+    draft_gap = 2.0
+    defer_orientation = True
+    derive_resolutions = True
+
+    def __init__(self):
+        # The source buffers of the images by id, to decode a smaller version
+        # in ``draft``. Images have ``__slots__`` so they can't carry them.
+        self._buffers = {}
+
+    def get_image(self, source):
+        buffer = source.read()
+        image = pyvips.Image.new_from_buffer(buffer, '')
+        self._buffers[id(image)] = buffer
+        return image
+
+    def cleanup(self, image):
+        self._buffers.pop(id(image), None)
+
+    def get_image_size(self, image):
+        return image.width, image.height
+
+    def is_valid_image(self, raw_data):
+        try:
+            pyvips.Image.new_from_buffer(raw_data, '')
+        except pyvips.Error:
+            return False
+        return True
+
+    def draft(self, image, targets):
+        # Loaders that can shrink-on-load (JPEG, WebP, SVG, PDF, ...) decode
+        # straight to the size needed instead of the full image.
+        buffer = self._buffers.pop(id(image), None)
+        if buffer is None:
+            return image
+        x_image, y_image = map(float, self.get_image_size(image))
+        transposed = self._get_orientation(image) in (5, 6, 7, 8)
+
+        factor = 0
+        for geometry, options in targets:
+            if options.get('cropbox'):
+                return image
+            if transposed and options.get('orientation', settings.THUMBNAIL_ORIENTATION):
+                size = y_image, x_image
+            else:
+                size = x_image, y_image
+            factor = max(factor, self._calculate_scaling_factor(
+                size[0], size[1], geometry, options))
+        factor *= self.draft_gap
+        if not targets or factor > 0.5:
+            return image
+
+        # The draft can only be read once from top to bottom, it is small
+        # enough to be kept in memory for all the thumbnails made from it.
+        return pyvips.Image.thumbnail_buffer(
+            buffer, int(x_image * factor + 0.999),
+            height=int(y_image * factor + 0.999), size='down',
+            no_rotate=True).copy_memory()
+
+    def _get_orientation(self, image):
+        if image.get_typeof('orientation'):
+            return image.get('orientation')
+
+    def _cropbox(self, image, x, y, x2, y2):
+        return image.crop(x, y, x2 - x, y2 - y)
+
+    def _orientation(self, image):
+        if self._get_orientation(image):
+            return image.autorot()
+        return image
+
+    def _transpose(self, image, orientation):
+        # The orientation is kept when the image is scaled
+        return image.autorot()
+
+    def _can_defer_colorspace(self, image, colorspace):
+        # Black and white images are made sRGB after scaling, on a third of
+        # the data
+        return colorspace == 'RGB' and image.interpretation in ('srgb', 'b-w')
+
+    def _colorspace(self, image, colorspace):
+        if colorspace == 'RGB':
+            if image.interpretation != 'srgb':
+                return image.colourspace('srgb')
+        elif colorspace == 'GRAY':
+            if image.interpretation != 'b-w':
+                return image.colourspace('b-w')
+        return image
+
+    def _scale(self, image, width, height):
+        return image.resize(float(width) / image.width,
+                            vscale=float(height) / image.height)
+
+    def _crop(self, image, width, height, x_offset, y_offset):
+        return image.crop(x_offset, y_offset, width, height)
+
+    def _rounded(self, image, r):
+        width, height = self.get_image_size(image)
+        xyz = pyvips.Image.xyz(width, height)
+        # Distance of each pixel center to the center of the nearest corner
+        # circle, zero along the straight edges.
+        x = xyz[0] + 0.5
+        y = xyz[1] + 0.5
+        dx = (x < r).ifthenelse(r - x, (x > width - r).ifthenelse(x - (width - r), 0))
+        dy = (y < r).ifthenelse(r - y, (y > height - r).ifthenelse(y - (height - r), 0))
+        mask = (dx * dx + dy * dy <= r * r).ifthenelse(255, 0).cast('uchar')
+        if image.hasalpha():
+            image = image.extract_band(0, n=image.bands - 1)
+        return image.bandjoin(mask)
+
+    def _blur(self, image, radius):
+        return image.gaussblur(radius)
+
+    def _padding(self, image, geometry, options):
+        x_image, y_image = self.get_image_size(image)
+        left = int((geometry[0] - x_image) / 2)
+        top = int((geometry[1] - y_image) / 2)
+        color = parse_color(options.get('padding_color'), image.bands)
+        return image.embed(left, top, geometry[0], geometry[1],
+                           extend='background', background=color)
+
+    def _get_raw_data(self, image, format_, quality, image_info=None, progressive=False):
+        params = {'strip': True}
+        if format_ == 'JPEG':
+            if image.hasalpha():
+                image = image.flatten(background=255)
+            params['Q'] = quality
+            params['interlace'] = progressive
+        elif format_ == 'WEBP':
+            params['Q'] = quality
+        return image.write_to_buffer(SUFFIXES.get(format_, '.jpg'), **params)
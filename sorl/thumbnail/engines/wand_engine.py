@@ -8,9 +8,14 @@ from sorl.thumbnail.engines.base import EngineBase
 
 
 class Engine(EngineBase):
+    derive_resolutions = True
+
     def get_image(self, source):
         return Image(blob=source.read())
 
+    def copy_image(self, image):
+        return image.clone()
+
     def get_image_size(self, image):
         return image.size
 
@@ -1,9 +1,15 @@
+import functools
 import hashlib
 
 from django.core.exceptions import ImproperlyConfigured
 from django.utils.encoding import smart_text
 from django.utils.importlib import import_module
-from sorl.thumbnail.compat import json, encode
+from sorl.thumbnail.compat import json, encode, text_type
+from sorl.thumbnail.conf import settings
+
+
+# Hash constructors by ``THUMBNAIL_KEY_HASH``
+_hashes = {}
 
 
 class ThumbnailError(Exception):
@@ -29,13 +35,54 @@ def toint(number):
     return int(number)
 
 
+def get_hash(data=b''):
+    """
+    Returns a new hash object of the ``THUMBNAIL_KEY_HASH`` algorithm fed with
+    ``data``.
+    """
+    name = settings.THUMBNAIL_KEY_HASH
+    try:
+        return _hashes[name](data)
+    except KeyError:
+        pass
+
+    digest_size = settings.THUMBNAIL_KEY_DIGEST_SIZE
+    constructor = getattr(hashlib, name, None)
+    if constructor is None:
+        if name not in getattr(hashlib, 'algorithms_available', ()):
+            raise ImproperlyConfigured('Unknown THUMBNAIL_KEY_HASH: %s' % name)
+        constructor = functools.partial(hashlib.new, name)
+    if digest_size:
+        constructor = functools.partial(constructor, digest_size=digest_size)
+    try:
+        hash_ = constructor(data)
+    except (TypeError, ValueError) as e:
+        raise ImproperlyConfigured('Bad THUMBNAIL_KEY_HASH: %s' % e)
+    _hashes[name] = constructor
+    return hash_
+
+
 def tokey(*args):
     """
     Computes a unique key from arguments given.
     """
-    salt = '||'.join([smart_text(arg) for arg in args])
-    hash_ = hashlib.md5(encode(salt))
-    return hash_.hexdigest()
+    salt = '||'.join([arg if isinstance(arg, text_type) else smart_text(arg)
+                      for arg in args])
+    return get_hash(encode(salt)).hexdigest()
+
+
+def chunks(iterable, size):
+    """
+    Splits iterable into lists of at most size items, consuming it lazily.
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
 
 
 def serialize(obj):
@@ -1,4 +1,6 @@
+import os
 import re
+import threading
 
 from django.core.files.base import File, ContentFile
 from django.core.files.storage import Storage, default_storage
@@ -8,14 +10,26 @@ from sorl.thumbnail import default
 from sorl.thumbnail.conf import settings
 
 from sorl.thumbnail.compat import json, urlopen, urlparse, urlsplit, \
-    quote, quote_plus, \
-    URLError, force_unicode, encode
+    quote, quote_plus, Request, \
+    URLError, HTTPError, force_unicode, encode
 from sorl.thumbnail.helpers import ThumbnailError, \
-    tokey, get_module_class, deserialize
+    tokey, get_module_class, deserialize, get_hash
 from sorl.thumbnail.parsers import parse_geometry
+from sorl.thumbnail.sizes import probe_image_size, MAX_HEADER_SIZE
+
+try:
+    import urllib3
+except ImportError:
+    urllib3 = None
 
 
 url_pat = re.compile(r'^(https?|ftp):\/\/')
+http_pat = re.compile(r'^https?:\/\/')
+
+# The connection pool of the process, see ``get_pool``
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
 
 
 def serialize_image_file(image_file):
@@ -30,14 +44,26 @@ def serialize_image_file(image_file):
     return json.dumps(data)
 
 
-def deserialize_image_file(s):
-    data = deserialize(s)
+class LazyStorage(LazyObject):
+    """
+    The storage class with the path given, set up when it is first used
+    """
 
-    class LazyStorage(LazyObject):
-        def _setup(self):
-            self._wrapped = get_module_class(data['storage'])()
+    def __init__(self, path):
+        super(LazyStorage, self).__init__()
+        # Not ``path``, that would hide ``Storage.path``
+        self.__dict__['_storage_class_path'] = path
 
-    image_file = ImageFile(data['name'], LazyStorage())
+    def _setup(self):
+        self._wrapped = get_module_class(self.__dict__['_storage_class_path'])()
+
+
+def deserialize_image_file(s):
+    data = deserialize(s)
+    storage = LazyStorage(data['storage'])
+    image_file = ImageFile(data['name'], storage)
+    # Saves setting up the storage just to find out its class
+    image_file._storage_path = storage, data['storage']
     image_file.set_size(data['size'])
     return image_file
 
@@ -74,6 +100,12 @@ class BaseImageFile(object):
 
 class ImageFile(BaseImageFile):
     _size = None
+    # ``(name, storage, key)`` and ``(storage, serialized storage)`` computed
+    # last
+    _key = None
+    _storage_path = None
+    # Set by the backend when ``THUMBNAIL_CONTENT_KEYS`` is on
+    content_key = None
 
     def __init__(self, file_, storage=None):
         if not file_:
@@ -114,11 +146,25 @@ class ImageFile(BaseImageFile):
             # optimizes this.
             size = self.storage.image_size(self.name)
         else:
-            # This is the worst case scenario
-            image = default.engine.get_image(self)
-            size = default.engine.get_image_size(image)
+            # Most formats tell the size in their first few bytes
+            size = self.probe_size()
+            if size is None:
+                # This is the worst case scenario
+                image = default.engine.get_image(self)
+                size = default.engine.get_image_size(image)
         self._size = list(size)
 
+    def probe_size(self):
+        """
+        Returns the size read from the header of the file, ``None`` if it
+        could not be read that way.
+        """
+        fp = self.storage.open(self.name)
+        try:
+            return probe_image_size(fp)
+        finally:
+            fp.close()
+
     @property
     def size(self):
         return self._size
@@ -128,6 +174,8 @@ class ImageFile(BaseImageFile):
         return self.storage.url(self.name)
 
     def read(self):
+        if settings.THUMBNAIL_SOURCE_CACHE:
+            return default.source_cache.read(self)
         return self.storage.open(self.name).read()
 
     def write(self, content):
@@ -142,7 +190,23 @@ class ImageFile(BaseImageFile):
     def delete(self):
         return self.storage.delete(self.name)
 
+    def digest(self):
+        """
+        Returns the hex digest of the contents of the file
+        """
+        hash_ = get_hash()
+        fp = self.storage.open(self.name)
+        try:
+            for chunk in iter(lambda: fp.read(64 * 1024), b''):
+                hash_.update(chunk)
+        finally:
+            fp.close()
+        return hash_.hexdigest()
+
     def serialize_storage(self):
+        if self._storage_path is not None and self._storage_path[0] is self.storage:
+            return self._storage_path[1]
+
         if isinstance(self.storage, LazyObject):
             # if storage is wrapped in a lazy object we need to get the real
             # thing.
@@ -151,11 +215,16 @@ class ImageFile(BaseImageFile):
             cls = self.storage._wrapped.__class__
         else:
             cls = self.storage.__class__
-        return '%s.%s' % (cls.__module__, cls.__name__)
+        path = '%s.%s' % (cls.__module__, cls.__name__)
+        self._storage_path = self.storage, path
+        return path
 
     @property
     def key(self):
-        return tokey(self.name, self.serialize_storage())
+        # The name changes when the file is written
+        if self._key is None or self._key[0] != self.name or self._key[1] is not self.storage:
+            self._key = self.name, self.storage, tokey(self.name, self.serialize_storage())
+        return self._key[2]
 
     def serialize(self):
         return serialize_image_file(self)
@@ -178,6 +247,57 @@ class DummyImageFile(BaseImageFile):
         )
 
 
+def get_pool():
+    """
+    Returns the urllib3 pool manager of the current process, which keeps
+    connections to the hosts sources are fetched from alive between requests.
+    """
+    global _pool, _pool_pid
+    with _pool_lock:
+        # Sockets can't be shared with forked processes
+        if _pool is None or _pool_pid != os.getpid():
+            timeout = urllib3.Timeout(
+                connect=settings.THUMBNAIL_URL_CONNECT_TIMEOUT or settings.THUMBNAIL_URL_TIMEOUT,
+                read=settings.THUMBNAIL_URL_TIMEOUT)
+            _pool = urllib3.PoolManager(maxsize=settings.THUMBNAIL_URL_POOL_SIZE,
+                                        timeout=timeout)
+            _pool_pid = os.getpid()
+        return _pool
+
+
+class PooledResponse(object):
+    """
+    A response of the connection pool that raises ``URLError`` like ``urlopen``
+    when the connection fails while it is being read
+    """
+
+    def __init__(self, response):
+        self.response = response
+
+    def read(self, *args, **kwargs):
+        try:
+            return self.response.read(*args, **kwargs)
+        except urllib3.exceptions.HTTPError as e:
+            raise URLError(e)
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+
+class UrlRequest(Request):
+    """
+    A request with the HTTP method given, which Python 2 ``Request`` does not
+    take
+    """
+
+    def __init__(self, url, headers={}, method=None):
+        Request.__init__(self, url, headers=headers)
+        self._method = method
+
+    def get_method(self):
+        return self._method or Request.get_method(self)
+
+
 class UrlStorage(Storage):
     def normalize_url(self, url, charset='utf-8'):
         url = encode(url, charset, 'ignore')
@@ -191,20 +311,87 @@ class UrlStorage(Storage):
 
         return urlparse.urlunsplit((scheme, netloc, path, qs, anchor))
 
-    def open(self, name, mode='rb'):
-        return urlopen(
-            self.normalize_url(name),
-            None,
-            settings.THUMBNAIL_URL_TIMEOUT
-        )
+    def open(self, name, mode='rb', headers=None, method=None):
+        url = self.normalize_url(name)
+        if urllib3 is not None and http_pat.match(url):
+            return self._pool_open(url, headers, method)
+        request = UrlRequest(url, headers=headers or {}, method=method)
+        return urlopen(request, None, settings.THUMBNAIL_URL_TIMEOUT)
+
+    def _pool_open(self, url, headers, method):
+        """
+        Opens the url with a pooled keep-alive connection. The connection goes
+        back to the pool once the response has been read to the end.
+        """
+        try:
+            response = get_pool().request(method or 'GET', url, headers=headers,
+                                          preload_content=method == 'HEAD')
+        except urllib3.exceptions.HTTPError as e:
+            raise URLError(e)
+        if response.status >= 400:
+            response.close()
+            raise HTTPError(url, response.status, response.reason,
+                            response.headers, None)
+        return PooledResponse(response)
 
     def exists(self, name):
         try:
-            self.open(name)
+            self.open(name, method='HEAD').close()
+        except HTTPError as e:
+            if e.code not in (403, 405, 501):
+                return False
+            # The server does not do HEAD, or like presigned S3 and Google
+            # Cloud Storage urls only allows the method signed for
+            try:
+                self.open(name, headers={'Range': 'bytes=0-0'}).close()
+            except URLError:
+                return False
         except URLError:
             return False
         return True
 
+    def open_if_modified(self, name, etag=None, last_modified=None):
+        """
+        Opens the url unless it has not changed since it had the ``ETag`` or
+        ``Last-Modified`` given, then returns ``None``.
+        """
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        try:
+            fp = self.open(name, headers=headers)
+        except HTTPError as e:
+            if e.code == 304:
+                return None
+            raise
+        if getattr(fp, 'status', None) == 304:
+            fp.close()
+            return None
+        return fp
+
+    def image_size(self, name):
+        """
+        Reads the size of the image from its header, fetched with a range
+        request, and only downloads all of it when that does not work out.
+        """
+        fp = self.open(name, headers={'Range': 'bytes=0-%d' % (MAX_HEADER_SIZE - 1)})
+        try:
+            # Servers that ignore the range send the whole image, of which
+            # only the start is read.
+            size = probe_image_size(fp)
+            if getattr(fp, 'status', None) == 206:
+                # Short enough to read the rest, which lets a pooled
+                # connection be reused
+                fp.read()
+        finally:
+            fp.close()
+        if size is None:
+            image = default.engine.get_image(ImageFile(name, self))
+            size = default.engine.get_image_size(image)
+        return size
+
     def url(self, name):
         return name
 
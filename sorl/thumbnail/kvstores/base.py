@@ -1,6 +1,13 @@
 from __future__ import unicode_literals
+import time
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
+
 from sorl.thumbnail.conf import settings
-from sorl.thumbnail.helpers import serialize, deserialize, ThumbnailError
+from sorl.thumbnail.helpers import serialize, deserialize, chunks, ThumbnailError
 from sorl.thumbnail.images import serialize_image_file, deserialize_image_file
 
 
@@ -25,25 +32,29 @@ class KVStoreBase(object):
         """
         return self._get(image_file.key)
 
+    def get_many(self, image_files):
+        """
+        Gets the ``image_files`` from store in one go. Returns a list in the
+        same order with ``None`` for the ones not found.
+        """
+        return self._get_many([image_file.key for image_file in image_files])
+
     def set(self, image_file, source=None):
         """
         Updates store for the `image_file`. Makes sure the `image_file` has a
         size set.
         """
         image_file.set_size()  # make sure its got a size
-        self._set(image_file.key, image_file)
-        if source is not None:
-            if not self.get(source):
-                # make sure the source is in kvstore
-                raise ThumbnailError('Cannot add thumbnails for source: `%s` '
-                                     'that is not in kvstore.' % source.name)
+        if source is None:
+            self._set(image_file.key, image_file)
+            return
 
-            # Update the list of thumbnails for source.
-            thumbnails = self._get(source.key, identity='thumbnails') or []
-            thumbnails = set(thumbnails)
-            thumbnails.add(image_file.key)
+        if not self.get(source):
+            # make sure the source is in kvstore
+            raise ThumbnailError('Cannot add thumbnails for source: `%s` '
+                                 'that is not in kvstore.' % source.name)
 
-            self._set(source.key, list(thumbnails), identity='thumbnails')
+        self._set_thumbnail(image_file, source)
 
     def get_or_set(self, image_file):
         cached = self.get(image_file)
@@ -61,12 +72,14 @@ class KVStoreBase(object):
         if delete_thumbnails:
             self.delete_thumbnails(image_file)
         self._delete(image_file.key)
+        if settings.THUMBNAIL_CONTENT_KEYS:
+            self._delete(image_file.key, identity='content')
 
     def delete_thumbnails(self, image_file):
         """
         Deletes references to thumbnails as well as thumbnail ``image_files``.
         """
-        thumbnail_keys = self._get(image_file.key, identity='thumbnails')
+        thumbnail_keys = self._get_thumbnail_keys(image_file.key)
         if thumbnail_keys:
             # Delete all thumbnail keys from store and delete the
             # thumbnail ImageFiles.
@@ -80,44 +93,144 @@ class KVStoreBase(object):
             # Delete the thumbnails key from store
             self._delete(image_file.key, identity='thumbnails')
 
-    def cleanup(self):
+    def get_content_key(self, image_file):
         """
-        Cleans up the key value store. In detail:
-        1. Deletes all key store references for image_files that do not exist
-           and all key references for its thumbnails *and* their image_files.
-        2. Deletes or updates all invalid thumbnail keys
+        Returns the key of the contents of ``image_file``, the same for all
+        files with the same contents. It is computed once and then kept in the
+        store. Returns ``None`` if the file can not be read.
         """
-        for key in self._find_keys(identity='image'):
-            image_file = self._get(key)
-
-            if image_file and not image_file.exists():
-                self.delete(image_file)
+        content_key = self._get(image_file.key, identity='content')
+        if content_key is not None:
+            return content_key
+        return self._compute_content_key(image_file)
 
-        for key in self._find_keys(identity='thumbnails'):
-            # We do not need to check for file existence in here since we
-            # already did that above for all image references
-            image_file = self._get(key)
+    def get_content_keys(self, image_files):
+        """
+        Same as ``get_content_key`` for many ``image_files``, the ones already
+        in the store are looked up in one go.
+        """
+        content_keys = self._get_many([image_file.key for image_file in image_files],
+                                      identity='content')
+        return [self._compute_content_key(image_file) if content_key is None else content_key
+                for image_file, content_key in zip(image_files, content_keys)]
 
-            if image_file:
-                # if there is an image_file then we check all of its thumbnails
-                # for existence
-                thumbnail_keys = self._get(key, identity='thumbnails') or []
-                thumbnail_keys_set = set(thumbnail_keys)
+    def _compute_content_key(self, image_file):
+        if settings.THUMBNAIL_BROKEN_TIMEOUT and self.is_broken(image_file):
+            return None
+        try:
+            content_key = image_file.digest()
+        except IOError:
+            return None
+        self._set(image_file.key, content_key, identity='content')
+        return content_key
 
-                for thumbnail_key in thumbnail_keys:
-                    if not self._get(thumbnail_key):
-                        thumbnail_keys_set.remove(thumbnail_key)
+    def set_broken(self, image_file):
+        """
+        Remembers for ``THUMBNAIL_BROKEN_TIMEOUT`` seconds that ``image_file``
+        could not be read.
+        """
+        expires = time.time() + settings.THUMBNAIL_BROKEN_TIMEOUT
+        self._set(image_file.key, expires, identity='broken')
 
-                thumbnail_keys = list(thumbnail_keys_set)
+    def is_broken(self, image_file):
+        """
+        Whether ``image_file`` could not be read within the last
+        ``THUMBNAIL_BROKEN_TIMEOUT`` seconds.
+        """
+        expires = self._get(image_file.key, identity='broken')
+        return expires is not None and expires > time.time()
 
-                if thumbnail_keys:
-                    self._set(key, thumbnail_keys, identity='thumbnails')
+    def delete_broken(self, expired_only=False):
+        """
+        Forgets about images that could not be read, so they are tried again.
+        """
+        now = time.time()
+        for key in self._find_keys(identity='broken'):
+            if expired_only:
+                expires = self._get(key, identity='broken')
+                if expires is not None and expires > now:
                     continue
+            self._delete(key, identity='broken')
 
-            # if there is no image_file then this thumbnails key is just
-            # hangin' loose, If the thumbnail_keys ended up empty there is no
-            # reason for keeping it either
-            self._delete(key, identity='thumbnails')
+    def cleanup(self, workers=1, chunk_size=None, report=None):
+        """
+        Cleans up the key value store. In detail:
+        1. Deletes all key store references for image_files that do not exist
+           and all key references for its thumbnails *and* their image_files.
+        2. Deletes or updates all invalid thumbnail keys
+        3. Deletes expired references to images that could not be read
+
+        Keys are handled ``chunk_size`` at a time, reading their values in one
+        go, and whether the images of a chunk exist is checked by ``workers``
+        threads. ``report`` is called with the counts after each chunk.
+        Returns the counts, a dict with the number of ``images`` checked and
+        ``deleted``, and the number of ``thumbnails`` lists checked and
+        ``stale`` thumbnail keys removed from them or deleted with them.
+        """
+        chunk_size = chunk_size or settings.THUMBNAIL_KVSTORE_CHUNK_SIZE
+        stats = dict(images=0, deleted=0, thumbnails=0, stale=0)
+        executor = None
+        if workers > 1:
+            if ThreadPoolExecutor is None:
+                raise ThumbnailError('Cleaning up with more than one worker '
+                                     'requires the futures backport.')
+            executor = ThreadPoolExecutor(workers)
+
+        try:
+            for keys in chunks(self._find_keys(identity='image'), chunk_size):
+                image_files = [image_file for image_file in self._get_many(keys)
+                               if image_file]
+                if executor is not None:
+                    exists = list(executor.map(lambda image_file: image_file.exists(),
+                                               image_files))
+                else:
+                    exists = [image_file.exists() for image_file in image_files]
+
+                for image_file, image_exists in zip(image_files, exists):
+                    if not image_exists:
+                        self.delete(image_file)
+                        stats['deleted'] += 1
+                stats['images'] += len(keys)
+                if report is not None:
+                    report(stats)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        for keys in chunks(self._find_keys(identity='thumbnails'), chunk_size):
+            # We do not need to check for file existence in here since we
+            # already did that above for all image references
+            image_files = self._get_many_raw([add_prefix(key) for key in keys])
+            thumbnail_keys = self._get_many_thumbnail_keys(keys)
+            existing = self._get_many_raw([add_prefix(thumbnail_key)
+                                           for key_thumbnails in thumbnail_keys
+                                           for thumbnail_key in key_thumbnails])
+            existing = iter(existing)
+
+            for key, image_file, key_thumbnails in zip(keys, image_files, thumbnail_keys):
+                stale_keys = [thumbnail_key for thumbnail_key in key_thumbnails
+                              if not next(existing)]
+
+                if image_file:
+                    # if there is an image_file then we check all of its
+                    # thumbnails for existence
+                    if len(stale_keys) < len(key_thumbnails):
+                        if stale_keys:
+                            self._remove_thumbnail_keys(key, stale_keys)
+                            stats['stale'] += len(stale_keys)
+                        continue
+
+                # if there is no image_file then this thumbnails key is just
+                # hangin' loose, If the thumbnail_keys ended up empty there is
+                # no reason for keeping it either
+                self._delete(key, identity='thumbnails')
+                stats['stale'] += len(key_thumbnails)
+            stats['thumbnails'] += len(keys)
+            if report is not None:
+                report(stats)
+
+        self.delete_broken(expired_only=True)
+        return stats
 
     def clear(self):
         """
@@ -125,16 +238,25 @@ class KVStoreBase(object):
         prefix. Use this in emergency situations. Normally you would probably
         want to use the ``cleanup`` method instead.
         """
-        all_keys = self._find_keys_raw(settings.THUMBNAIL_KEY_PREFIX)
-        if all_keys:
-            self._delete_raw(*all_keys)
+        all_keys = self._find_keys_raw(settings.THUMBNAIL_KEY_PREFIX) or []
+        for keys in chunks(all_keys, settings.THUMBNAIL_KVSTORE_CHUNK_SIZE):
+            self._delete_raw(*keys)
 
     def _get(self, key, identity='image'):
         """
         Deserializing, prefix wrapper for _get_raw
         """
         value = self._get_raw(add_prefix(key, identity))
+        return self._deserialize(value, identity)
+
+    def _get_many(self, keys, identity='image'):
+        """
+        Deserializing, prefix wrapper for _get_many_raw
+        """
+        values = self._get_many_raw([add_prefix(key, identity) for key in keys])
+        return [self._deserialize(value, identity) for value in values]
 
+    def _deserialize(self, value, identity='image'):
         if not value:
             return None
 
@@ -159,6 +281,46 @@ class KVStoreBase(object):
         """
         self._delete_raw(add_prefix(key, identity))
 
+    def _set_thumbnail(self, image_file, source):
+        """
+        Stores the thumbnail ``image_file`` and adds it to the list of
+        thumbnails for ``source``.
+        """
+        self._set(image_file.key, image_file)
+
+        # Update the list of thumbnails for source.
+        thumbnails = set(self._get_thumbnail_keys(source.key))
+        thumbnails.add(image_file.key)
+
+        self._set(source.key, list(thumbnails), identity='thumbnails')
+
+    def _get_thumbnail_keys(self, key):
+        """
+        Returns the list of thumbnail keys for the image with ``key``
+        """
+        return self._get(key, identity='thumbnails') or []
+
+    def _get_many_thumbnail_keys(self, keys):
+        """
+        Returns the lists of thumbnail keys for the images with ``keys``, in
+        the same order
+        """
+        return [thumbnail_keys or []
+                for thumbnail_keys in self._get_many(keys, identity='thumbnails')]
+
+    def _remove_thumbnail_keys(self, key, thumbnail_keys):
+        """
+        Removes ``thumbnail_keys`` from the list of thumbnails for the image with
+        ``key``, the list is deleted when it ends up empty.
+        """
+        thumbnails = set(self._get_thumbnail_keys(key))
+        thumbnails.difference_update(thumbnail_keys)
+
+        if thumbnails:
+            self._set(key, list(thumbnails), identity='thumbnails')
+        else:
+            self._delete(key, identity='thumbnails')
+
     def _find_keys(self, identity='image'):
         """
         Finds and returns all keys for identity,
@@ -177,6 +339,14 @@ class KVStoreBase(object):
         """
         raise NotImplemented()
 
+    def _get_many_raw(self, keys):
+        """
+        Gets the values for keys from keystore as a list in the same order,
+        with `None` for the ones not found. Key-value stores that can fetch
+        many keys in one round trip should override this.
+        """
+        return [self._get_raw(key) for key in keys]
+
     def _set_raw(self, key, value):
         """
         Sets value associated to key. Key is expected to be shorter than 200
@@ -193,7 +363,8 @@ class KVStoreBase(object):
 
     def _find_keys_raw(self, prefix):
         """
-        Finds all keys with prefix
+        Finds all keys with prefix. Can return any iterable, key-value stores
+        with a lot of keys should yield them as they go.
         """
         raise NotImplemented()
 
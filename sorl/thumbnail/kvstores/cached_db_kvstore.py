@@ -39,6 +39,20 @@ class KVStore(KVStoreBase):
             return None
         return value
 
+    def _get_many_raw(self, keys):
+        values = self.cache.get_many(keys)
+        missing = [key for key in keys if key not in values]
+        if missing:
+            for kv in KVStoreModel.objects.filter(key__in=missing):
+                values[kv.key] = kv.value
+            # we set the cache for the missing keys too to prevent further db
+            # lookups
+            self.cache.set_many(
+                dict((key, values.get(key, EMPTY_VALUE)) for key in missing),
+                settings.THUMBNAIL_CACHE_TIMEOUT)
+        return [None if values.get(key, EMPTY_VALUE) == EMPTY_VALUE else values[key]
+                for key in keys]
+
     def _set_raw(self, key, value):
         KVStoreModel.objects.get_or_create(
             key=key, defaults={'value': value})
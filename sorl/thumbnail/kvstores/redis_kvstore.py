@@ -1,26 +1,39 @@
 import redis
-from sorl.thumbnail.kvstores.base import KVStoreBase
+from sorl.thumbnail.kvstores.base import KVStoreBase, add_prefix
 from sorl.thumbnail.conf import settings
+from sorl.thumbnail.helpers import deserialize
+from sorl.thumbnail.images import serialize_image_file
+
+
+def get_connection():
+    """
+    Returns a Redis connection configured by the ``THUMBNAIL_REDIS_*``
+    settings
+    """
+    if hasattr(settings, 'THUMBNAIL_REDIS_URL'):
+        return redis.from_url(settings.THUMBNAIL_REDIS_URL)
+    return redis.Redis(
+        host=settings.THUMBNAIL_REDIS_HOST,
+        port=settings.THUMBNAIL_REDIS_PORT,
+        db=settings.THUMBNAIL_REDIS_DB,
+        password=settings.THUMBNAIL_REDIS_PASSWORD,
+        unix_socket_path=settings.THUMBNAIL_REDIS_UNIX_SOCKET_PATH,
+    )
 
 
 class KVStore(KVStoreBase):
     def __init__(self, *args, **kwargs):
         super(KVStore, self).__init__(*args, **kwargs)
-
-        if hasattr(settings, 'THUMBNAIL_REDIS_URL'):
-            self.connection = redis.from_url(settings.THUMBNAIL_REDIS_URL)
-        else:
-            self.connection = redis.Redis(
-                host=settings.THUMBNAIL_REDIS_HOST,
-                port=settings.THUMBNAIL_REDIS_PORT,
-                db=settings.THUMBNAIL_REDIS_DB,
-                password=settings.THUMBNAIL_REDIS_PASSWORD,
-                unix_socket_path=settings.THUMBNAIL_REDIS_UNIX_SOCKET_PATH,
-            )
+        self.connection = get_connection()
 
     def _get_raw(self, key):
         return self.connection.get(key)
 
+    def _get_many_raw(self, keys):
+        if not keys:
+            return []
+        return self.connection.mget(keys)
+
     def _set_raw(self, key, value):
         return self.connection.set(key, value)
 
@@ -28,7 +41,70 @@ class KVStore(KVStoreBase):
         return self.connection.delete(*keys)
 
     def _find_keys_raw(self, prefix):
+        # SCAN does not block the server like KEYS does on large databases
         pattern = prefix + '*'
-        return list(map(lambda key: key.decode('utf-8'),
-                        self.connection.keys(pattern=pattern)))
+        keys = self.connection.scan_iter(
+            match=pattern, count=settings.THUMBNAIL_REDIS_SCAN_COUNT)
+        for key in keys:
+            yield key.decode('utf-8')
+
+    #
+    # The thumbnails of an image are kept in a native Redis set so they can be
+    # added and removed atomically, without rewriting the whole list.
+    #
+    def _set_thumbnail(self, image_file, source):
+        thumbnails_key = add_prefix(source.key, identity='thumbnails')
+        pipe = self.connection.pipeline()
+        pipe.set(add_prefix(image_file.key), serialize_image_file(image_file))
+        pipe.sadd(thumbnails_key, image_file.key)
+        try:
+            pipe.execute()
+        except redis.ResponseError:
+            if not self._convert_thumbnail_keys(source.key):
+                raise
+            self.connection.sadd(thumbnails_key, image_file.key)
+
+    def _get_thumbnail_keys(self, key):
+        thumbnails_key = add_prefix(key, identity='thumbnails')
+        try:
+            thumbnail_keys = self.connection.smembers(thumbnails_key)
+        except redis.ResponseError:
+            if not self._convert_thumbnail_keys(key):
+                raise
+            thumbnail_keys = self.connection.smembers(thumbnails_key)
+        return [thumbnail_key.decode('utf-8') for thumbnail_key in thumbnail_keys]
+
+    def _get_many_thumbnail_keys(self, keys):
+        pipe = self.connection.pipeline()
+        for key in keys:
+            pipe.smembers(add_prefix(key, identity='thumbnails'))
+        results = pipe.execute(raise_on_error=False)
+        return [self._get_thumbnail_keys(key) if isinstance(thumbnail_keys, Exception)
+                else [thumbnail_key.decode('utf-8') for thumbnail_key in thumbnail_keys]
+                for key, thumbnail_keys in zip(keys, results)]
+
+    def _remove_thumbnail_keys(self, key, thumbnail_keys):
+        # Redis deletes the set when it ends up empty
+        thumbnails_key = add_prefix(key, identity='thumbnails')
+        try:
+            self.connection.srem(thumbnails_key, *thumbnail_keys)
+        except redis.ResponseError:
+            if not self._convert_thumbnail_keys(key):
+                raise
+            self.connection.srem(thumbnails_key, *thumbnail_keys)
 
+    def _convert_thumbnail_keys(self, key):
+        """
+        Converts a list of thumbnails stored as JSON by earlier versions to a
+        set. Returns ``False`` if there was no such list.
+        """
+        thumbnails_key = add_prefix(key, identity='thumbnails')
+        if self.connection.type(thumbnails_key) not in (b'string', 'string'):
+            return False
+        thumbnail_keys = deserialize(self.connection.get(thumbnails_key))
+        pipe = self.connection.pipeline()
+        pipe.delete(thumbnails_key)
+        if thumbnail_keys:
+            pipe.sadd(thumbnails_key, *thumbnail_keys)
+        pipe.execute()
+        return True
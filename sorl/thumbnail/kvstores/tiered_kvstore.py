@@ -0,0 +1,134 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from sorl.thumbnail.conf import settings
+from sorl.thumbnail.helpers import get_module_class
+from sorl.thumbnail.kvstores.base import KVStoreBase
+
+
+class LRUCache(object):
+    """
+    A thread safe mapping that holds on to at most ``size`` items, dropping
+    the least recently used ones, for at most ``ttl`` seconds each.
+    """
+
+    def __init__(self, size, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.pop(key, None)
+            if item is None:
+                return None
+            expires, value = item
+            if expires is not None and expires < time.time():
+                return None
+            self.items[key] = item
+            return value
+
+    def set(self, key, value):
+        expires = time.time() + self.ttl if self.ttl else None
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = (expires, value)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+class KVStore(KVStoreBase):
+    """
+    Keeps the image files last looked up in the ``THUMBNAIL_TIERED_KVSTORE``
+    key value store in memory, which saves a round trip and deserializing them
+    when they are looked up again.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(KVStore, self).__init__(*args, **kwargs)
+        self.store = get_module_class(settings.THUMBNAIL_TIERED_KVSTORE)()
+        self.cache = LRUCache(settings.THUMBNAIL_TIERED_SIZE,
+                              settings.THUMBNAIL_TIERED_TIMEOUT)
+
+    def clear(self):
+        self.cache.clear()
+        self.store.clear()
+
+    def _get(self, key, identity='image'):
+        if identity != 'image':
+            return self.store._get(key, identity)
+
+        image_file = self.cache.get(key)
+        if image_file is None:
+            image_file = self.store._get(key)
+            if image_file is None:
+                return None
+            self.cache.set(key, image_file)
+        # Callers may change the image file they get
+        return copy.copy(image_file)
+
+    def _get_many(self, keys, identity='image'):
+        if identity != 'image':
+            return self.store._get_many(keys, identity)
+
+        image_files = [self.cache.get(key) for key in keys]
+        missing = [key for key, image_file in zip(keys, image_files)
+                   if image_file is None]
+        if missing:
+            found = dict(zip(missing, self.store._get_many(missing)))
+            image_files = [found[key] if image_file is None else image_file
+                           for key, image_file in zip(keys, image_files)]
+        for key, image_file in zip(keys, image_files):
+            if image_file is not None:
+                self.cache.set(key, image_file)
+        return [image_file and copy.copy(image_file) for image_file in image_files]
+
+    def _set(self, key, value, identity='image'):
+        self.store._set(key, value, identity)
+        if identity == 'image':
+            self.cache.set(key, copy.copy(value))
+
+    def _delete(self, key, identity='image'):
+        if identity == 'image':
+            self.cache.delete(key)
+        self.store._delete(key, identity)
+
+    def _set_thumbnail(self, image_file, source):
+        self.store._set_thumbnail(image_file, source)
+        self.cache.set(image_file.key, copy.copy(image_file))
+
+    def _get_thumbnail_keys(self, key):
+        return self.store._get_thumbnail_keys(key)
+
+    def _get_many_thumbnail_keys(self, keys):
+        return self.store._get_many_thumbnail_keys(keys)
+
+    def _remove_thumbnail_keys(self, key, thumbnail_keys):
+        self.store._remove_thumbnail_keys(key, thumbnail_keys)
+
+    def _get_raw(self, key):
+        return self.store._get_raw(key)
+
+    def _get_many_raw(self, keys):
+        return self.store._get_many_raw(keys)
+
+    def _set_raw(self, key, value):
+        self.store._set_raw(key, value)
+
+    def _delete_raw(self, *keys):
+        self.cache.clear()
+        self.store._delete_raw(*keys)
+
+    def _find_keys_raw(self, prefix):
+        return self.store._find_keys_raw(prefix)
@@ -0,0 +1,46 @@
+from sorl.thumbnail.kvstores.base import add_prefix
+
+
+def lock_key(key):
+    """
+    Returns the name of the lock for a thumbnail key
+    """
+    return add_prefix(key, identity='lock')
+
+
+class LockBase(object):
+    """
+    Locks make sure a thumbnail is created by only one process at a time.
+    """
+
+    # Whether a lock that is held keeps others from acquiring it
+    exclusive = True
+
+    def acquire(self, key):
+        """
+        Tries to acquire the lock for the thumbnail ``key`` without waiting.
+        Returns ``True`` on success. Locks expire after
+        ``THUMBNAIL_LOCK_TIMEOUT`` seconds in case they are never released.
+        """
+        raise NotImplementedError()
+
+    def release(self, key):
+        """
+        Releases the lock for the thumbnail ``key``. Silent failure for locks
+        that are not held.
+        """
+        raise NotImplementedError()
+
+
+class DummyLock(LockBase):
+    """
+    Never locks, every process creates the thumbnails it misses.
+    """
+
+    exclusive = False
+
+    def acquire(self, key):
+        return True
+
+    def release(self, key):
+        pass
@@ -0,0 +1,33 @@
+import uuid
+
+from django.core.cache import cache, get_cache, InvalidCacheBackendError
+from sorl.thumbnail.conf import settings
+from sorl.thumbnail.locks.base import LockBase, lock_key
+
+
+class Lock(LockBase):
+    """
+    Lock using the atomic ``add`` of the ``THUMBNAIL_CACHE`` cache, the cache
+    needs to be shared by all processes, like memcached.
+    """
+
+    def __init__(self):
+        super(Lock, self).__init__()
+        try:
+            self.cache = get_cache(settings.THUMBNAIL_CACHE)
+        except InvalidCacheBackendError:
+            self.cache = cache
+        self.tokens = {}
+
+    def acquire(self, key):
+        token = uuid.uuid4().hex
+        if not self.cache.add(lock_key(key), token, settings.THUMBNAIL_LOCK_TIMEOUT):
+            return False
+        self.tokens[key] = token
+        return True
+
+    def release(self, key):
+        token = self.tokens.pop(key, None)
+        # don't release a lock that expired and was acquired by someone else
+        if token is not None and self.cache.get(lock_key(key)) == token:
+            self.cache.delete(lock_key(key))
@@ -0,0 +1,53 @@
+import errno
+import os
+import tempfile
+import time
+
+from sorl.thumbnail.conf import settings
+from sorl.thumbnail.locks.base import LockBase
+
+
+class Lock(LockBase):
+    """
+    Lock using exclusively created files in ``THUMBNAIL_LOCK_DIR``. Only
+    processes sharing that directory, usually the ones on the same host, are
+    locked out.
+    """
+
+    def __init__(self):
+        super(Lock, self).__init__()
+        self.directory = settings.THUMBNAIL_LOCK_DIR or tempfile.gettempdir()
+
+    def path(self, key):
+        return os.path.join(self.directory, 'sorl-thumbnail-%s.lock' % key)
+
+    def acquire(self, key):
+        path = self.path(key)
+        if self._create(path):
+            return True
+
+        # The process holding the lock might have died without releasing it
+        try:
+            if time.time() - os.path.getmtime(path) < settings.THUMBNAIL_LOCK_TIMEOUT:
+                return False
+            os.remove(path)
+        except OSError:
+            # released or taken over in the meantime
+            pass
+        return self._create(path)
+
+    def release(self, key):
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+    def _create(self, path):
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            return False
+        os.close(fd)
+        return True
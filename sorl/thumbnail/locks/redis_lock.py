@@ -0,0 +1,40 @@
+import uuid
+
+from sorl.thumbnail.conf import settings
+from sorl.thumbnail.kvstores.redis_kvstore import get_connection
+from sorl.thumbnail.locks.base import LockBase, lock_key
+
+
+# Deletes the lock only if it still holds our token
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class Lock(LockBase):
+    """
+    Lock using ``SET NX PX`` on the Redis server configured by the
+    ``THUMBNAIL_REDIS_*`` settings.
+    """
+
+    def __init__(self):
+        super(Lock, self).__init__()
+        self.connection = get_connection()
+        self.release_script = self.connection.register_script(RELEASE_SCRIPT)
+        self.tokens = {}
+
+    def acquire(self, key):
+        token = uuid.uuid4().hex
+        timeout = int(settings.THUMBNAIL_LOCK_TIMEOUT * 1000)
+        if not self.connection.set(lock_key(key), token, px=timeout, nx=True):
+            return False
+        self.tokens[key] = token
+        return True
+
+    def release(self, key):
+        token = self.tokens.pop(key, None)
+        if token is not None:
+            self.release_script(keys=[lock_key(key)], args=[token])
@@ -3,17 +3,51 @@
 from __future__ import unicode_literals, print_function
 
 import sys
+from optparse import make_option
 
+from django.core.files.storage import default_storage
 from django.core.management.base import BaseCommand, CommandError
+from django.db.models import get_model
 from sorl.thumbnail import default
+from sorl.thumbnail.helpers import ThumbnailError
+from sorl.thumbnail.images import ImageFile
+from sorl.thumbnail import sweep, warm
 
 
 class Command(BaseCommand):
     help = (
         'Handles thumbnails and key value store'
     )
-    args = '[cleanup, clear]'
-    option_list = BaseCommand.option_list
+    args = '[cleanup, clear, clear_broken, warm, sweep]'
+    option_list = BaseCommand.option_list + (
+        make_option('--model', dest='model',
+                    help='warm: images of this app_label.ModelName'),
+        make_option('--field', dest='field',
+                    help='warm: field of --model with the images'),
+        make_option('--files', dest='files',
+                    help='warm: file with the names or urls of the images, one per line'),
+        make_option('--prefix', dest='prefix',
+                    help='warm: directory of the default storage with the images'),
+        make_option('--spec', dest='specs', action='append', default=[],
+                    help='warm: thumbnail to create, like \'100x100 crop="center"\', '
+                         'can be given more than once'),
+        make_option('--workers', dest='workers', type='int', default=1,
+                    help='warm: number of processes creating thumbnails, '
+                         'cleanup: number of threads checking that images exist, '
+                         'sweep: number of threads deleting files'),
+        make_option('--chunk-size', dest='chunk_size', type='int', default=None,
+                    help='warm: number of images looked up at once, 100 by default, '
+                         'cleanup, sweep: number of keys handled at once, '
+                         'THUMBNAIL_KVSTORE_CHUNK_SIZE by default'),
+        make_option('--dry-run', dest='dry_run', action='store_true', default=False,
+                    help='warm: only count the thumbnails that are missing, '
+                         'sweep: only list the files that are not thumbnails'),
+        make_option('--min-age', dest='min_age', type='int', default=3600,
+                    help='sweep: seconds since files were last modified before '
+                         'they are deleted'),
+        make_option('--rate', dest='rate', type='float', default=None,
+                    help='sweep: maximum number of files deleted a second'),
+    )
 
     def handle(self, *labels, **options):
         verbosity = int(options.get('verbosity'))
@@ -34,14 +68,24 @@ class Command(BaseCommand):
 
         label = labels[0]
 
-        if label not in ['cleanup', 'clear']:
+        if label not in ['cleanup', 'clear', 'clear_broken', 'warm', 'sweep']:
             raise CommandError('`%s` unknown action' % label)
 
         if label == 'cleanup':
             if verbosity >= 1:
                 print("Cleanup thumbnails", end=' ... ', file=stdout)
 
-            default.kvstore.cleanup()
+            def report(stats):
+                if verbosity >= 2:
+                    print(file=stdout)
+                    print('%(images)d images checked, %(deleted)d deleted, '
+                          '%(thumbnails)d thumbnail lists checked, '
+                          '%(stale)d stale thumbnail keys removed' % stats,
+                          end=' ... ', file=stdout)
+
+            default.kvstore.cleanup(workers=options.get('workers') or 1,
+                                    chunk_size=options.get('chunk_size'),
+                                    report=report)
 
             if verbosity >= 1:
                 print("[Done]", file=stdout)
@@ -54,3 +98,103 @@ class Command(BaseCommand):
 
             if verbosity >= 1:
                 print('[Done]', file=stdout)
+
+        elif label == 'clear_broken':
+            if verbosity >= 1:
+                print("Forget images that could not be read", end=' ... ', file=stdout)
+
+            default.kvstore.delete_broken()
+
+            if verbosity >= 1:
+                print('[Done]', file=stdout)
+
+        elif label == 'warm':
+            self.warm_thumbnails(verbosity, stdout, options)
+
+        elif label == 'sweep':
+            self.sweep_thumbnails(verbosity, stdout, options)
+
+    def warm_thumbnails(self, verbosity, stdout, options):
+        sources = self.get_sources(options)
+        try:
+            thumbnail_specs = [warm.parse_spec(spec) for spec in options.get('specs', [])]
+        except ThumbnailError as e:
+            raise CommandError(str(e))
+        if not thumbnail_specs:
+            raise CommandError('warm needs at least one --spec')
+
+        def report(stats):
+            if verbosity >= 2:
+                print(self.format_stats(stats), file=stdout)
+
+        stats = warm.warm(sources, thumbnail_specs,
+                          workers=options.get('workers') or 1,
+                          chunk_size=options.get('chunk_size') or 100,
+                          dry_run=options.get('dry_run'),
+                          report=report)
+
+        if verbosity >= 1:
+            print(self.format_stats(stats), file=stdout)
+            if options.get('dry_run'):
+                print('%(missing)d thumbnails would be created' % stats, file=stdout)
+            else:
+                print('[Done]', file=stdout)
+
+    def sweep_thumbnails(self, verbosity, stdout, options):
+        dry_run = options.get('dry_run')
+        if verbosity >= 1:
+            print("Sweep files that are not thumbnails", end=' ... ', file=stdout)
+
+        def report(stats, deleted):
+            if verbosity >= 2:
+                print(file=stdout)
+                for name in deleted:
+                    print(name, file=stdout)
+                print('%(files)d files checked, %(orphans)d not thumbnails, '
+                      '%(deleted)d deleted in %(elapsed).1fs' % stats,
+                      end=' ... ', file=stdout)
+
+        stats = sweep.sweep(workers=options.get('workers') or 1,
+                            chunk_size=options.get('chunk_size'),
+                            min_age=options.get('min_age', 3600),
+                            rate=options.get('rate'),
+                            dry_run=dry_run,
+                            report=report)
+
+        if verbosity >= 1:
+            if dry_run:
+                print('%(deleted)d files would be deleted' % stats, file=stdout)
+            else:
+                print('[Done]', file=stdout)
+
+    def get_sources(self, options):
+        model, field = options.get('model'), options.get('field')
+        files, prefix = options.get('files'), options.get('prefix')
+
+        if model:
+            if not field:
+                raise CommandError('--model needs --field')
+            try:
+                app_label, model_name = model.split('.')
+            except ValueError:
+                raise CommandError('--model must be app_label.ModelName')
+            model_class = get_model(app_label, model_name)
+            if model_class is None:
+                raise CommandError('Unknown model `%s`' % model)
+            return warm.model_sources(model_class, field)
+
+        if files:
+            with open(files) as fp:
+                names = [line.strip() for line in fp]
+            return [ImageFile(name) for name in names if name]
+
+        if prefix is not None:
+            return warm.storage_sources(default_storage, prefix.strip('/'))
+
+        raise CommandError('warm needs --model and --field, --files or --prefix')
+
+    def format_stats(self, stats):
+        rate = stats['created'] / stats['elapsed'] if stats['elapsed'] else 0.0
+        return ('%(sources)d images, %(found)d thumbnails found, %(missing)d missing, '
+                '%(created)d created, %(failed)d failed in %(elapsed).1fs' % stats +
+                ' (%.1f thumbnails/s)' % rate)
@@ -0,0 +1,44 @@
+from sorl.thumbnail import default
+from sorl.thumbnail.helpers import get_module_class
+from sorl.thumbnail.images import ImageFile
+
+
+def make_job(source, thumbnail_specs):
+    """
+    Returns a JSON serializable description of the thumbnails to create for
+    the ``source`` ImageFile, for task queues running ``run_job`` in another
+    process.
+    """
+    return {
+        'name': source.name,
+        'storage': source.serialize_storage(),
+        'thumbnail_specs': [[geometry_string, options]
+                            for geometry_string, options in thumbnail_specs],
+    }
+
+
+def run_job(job):
+    """
+    Creates the thumbnails described by a job from ``make_job``
+    """
+    storage = get_module_class(job['storage'])()
+    source = ImageFile(job['name'], storage)
+    thumbnail_specs = [(geometry_string, options)
+                       for geometry_string, options in job['thumbnail_specs']]
+    return default.backend.create_thumbnails(source, thumbnail_specs)
+
+
+class QueueBase(object):
+    """
+    Queues create thumbnails outside of the request that needs them, see
+    ``THUMBNAIL_QUEUE``.
+    """
+
+    def enqueue(self, source, thumbnail_specs):
+        """
+        Schedules the creation of the thumbnails of the ``source`` ImageFile
+        for the ``(geometry_string, options)`` pairs given. Queues handing the
+        work to other processes can send ``make_job(source, thumbnail_specs)``
+        and have the worker call ``run_job`` with it.
+        """
+        raise NotImplementedError()
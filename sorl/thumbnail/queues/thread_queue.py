@@ -0,0 +1,46 @@
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from django.db import connection
+from sorl.thumbnail import default
+from sorl.thumbnail.conf import settings
+from sorl.thumbnail.helpers import serialize, tokey
+from sorl.thumbnail.queues.base import QueueBase
+
+
+logger = logging.getLogger(__name__)
+
+
+class Queue(QueueBase):
+    """
+    Creates thumbnails in a pool of ``THUMBNAIL_QUEUE_WORKERS`` threads of
+    the current process. Requires the ``futures`` backport on Python 2.
+    """
+
+    def __init__(self):
+        super(Queue, self).__init__()
+        self.executor = ThreadPoolExecutor(settings.THUMBNAIL_QUEUE_WORKERS)
+        self.pending = set()
+        self.pending_lock = threading.Lock()
+
+    def enqueue(self, source, thumbnail_specs):
+        # Pages asking for the same thumbnails while they are being created
+        # don't queue them again
+        job_key = tokey(source.key, serialize(thumbnail_specs))
+        with self.pending_lock:
+            if job_key in self.pending:
+                return
+            self.pending.add(job_key)
+        self.executor.submit(self.run, job_key, source, thumbnail_specs)
+
+    def run(self, job_key, source, thumbnail_specs):
+        try:
+            default.backend.create_thumbnails(source, thumbnail_specs)
+        except Exception:
+            logger.exception('Creating thumbnails for [%s] failed', source.name)
+        finally:
+            with self.pending_lock:
+                self.pending.discard(job_key)
+            # don't leave a database connection open per thread
+            connection.close()
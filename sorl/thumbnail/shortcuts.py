@@ -8,6 +8,20 @@ def get_thumbnail(file_, geometry_string, **options):
     return default.backend.get_thumbnail(file_, geometry_string, **options)
 
 
+def get_thumbnails(file_, thumbnail_specs):
+    """
+    A shortcut for the Backend ``get_thumbnails`` method
+    """
+    return default.backend.get_thumbnails(file_, thumbnail_specs)
+
+
+def prefetch_thumbnails(files, geometry_string, **options):
+    """
+    A shortcut for the Backend ``prefetch_thumbnails`` method
+    """
+    return default.backend.prefetch_thumbnails(files, geometry_string, **options)
+
+
 def delete(file_, delete_file=True):
     """
     A shortcut for the Backend ``delete`` method
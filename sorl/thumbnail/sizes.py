@@ -0,0 +1,133 @@
+"""
+Reads the size of an image from the first few bytes of the file, without
+decoding it.
+"""
+import struct
+
+
+# Give up on headers that are larger than this, JPEGs in particular can have
+# large exif and icc segments before the frame header.
+MAX_HEADER_SIZE = 256 * 1024
+
+# Read the file in chunks of this size
+CHUNK_SIZE = 4096
+
+# JPEG start of frame markers, DHT (C4), JPG (C8) and DAC (CC) are not
+SOF_MARKERS = frozenset([0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7,
+                         0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF])
+
+# JPEG markers without a length
+STANDALONE_MARKERS = frozenset([0x01, 0xD0, 0xD1, 0xD2, 0xD3, 0xD4, 0xD5,
+                                0xD6, 0xD7, 0xD8])
+
+
+class HeaderReader(object):
+    """
+    Reads a file object incrementally, up to ``MAX_HEADER_SIZE`` bytes
+    """
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.data = b''
+        self.pos = 0
+
+    def read(self, size):
+        end = self.pos + size
+        while len(self.data) < end:
+            if len(self.data) >= MAX_HEADER_SIZE:
+                return None
+            chunk = self.fp.read(CHUNK_SIZE)
+            if not chunk:
+                return None
+            self.data += chunk
+        data = self.data[self.pos:end]
+        self.pos = end
+        return data
+
+    def unpack(self, fmt):
+        data = self.read(struct.calcsize(fmt))
+        if data is None:
+            return None
+        return struct.unpack(fmt, data)
+
+
+def probe_image_size(fp):
+    """
+    Returns the (width, height) of the JPEG, PNG, GIF or WebP image read from
+    the file object given, or ``None`` when the format is not recognized or
+    the header is broken.
+    """
+    reader = HeaderReader(fp)
+    head = reader.read(12)
+    if head is None:
+        return None
+    try:
+        if head[:2] == b'\xff\xd8':
+            reader.pos = 2
+            return _jpeg_size(reader)
+        if head[:8] == b'\x89PNG\r\n\x1a\n':
+            reader.pos = 8
+            return _png_size(reader)
+        if head[:6] in (b'GIF87a', b'GIF89a'):
+            return struct.unpack('<HH', head[6:10])
+        if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+            return _webp_size(reader)
+    except struct.error:
+        pass
+    return None
+
+
+def _png_size(reader):
+    chunk = reader.unpack('>I4sII')
+    if chunk is None or chunk[1] != b'IHDR':
+        return None
+    return chunk[2], chunk[3]
+
+
+def _webp_size(reader):
+    header = reader.read(18)
+    if header is None:
+        return None
+    fourcc, data = header[:4], header[8:]
+    if fourcc == b'VP8 ' and data[3:6] == b'\x9d\x01\x2a':
+        width, height = struct.unpack('<HH', data[6:10])
+        return width & 0x3fff, height & 0x3fff
+    if fourcc == b'VP8L' and data[:1] == b'\x2f':
+        bits = struct.unpack('<I', data[1:5])[0]
+        return (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
+    if fourcc == b'VP8X':
+        width = struct.unpack('<I', data[4:7] + b'\x00')[0]
+        height = struct.unpack('<I', data[7:10] + b'\x00')[0]
+        return width + 1, height + 1
+    return None
+
+
+def _jpeg_size(reader):
+    while True:
+        # Markers are 0xFF followed by the marker code, any number of 0xFF
+        # may pad them.
+        byte = reader.read(1)
+        if byte != b'\xff':
+            return None
+        while byte == b'\xff':
+            byte = reader.read(1)
+        if byte is None:
+            return None
+        marker = ord(byte)
+        if marker in STANDALONE_MARKERS:
+            continue
+        if marker == 0xD9:
+            return None
+        length = reader.unpack('>H')
+        if length is None or length[0] < 2:
+            return None
+        if marker in SOF_MARKERS:
+            frame = reader.unpack('>BHH')
+            if frame is None:
+                return None
+            precision, height, width = frame
+            if not width or not height:
+                return None
+            return width, height
+        if reader.read(length[0] - 2) is None:
+            return None
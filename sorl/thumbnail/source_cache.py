@@ -0,0 +1,198 @@
+import logging
+import os
+import tempfile
+
+from sorl.thumbnail.compat import json
+from sorl.thumbnail.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+def is_local(storage, name):
+    """
+    Whether the storage keeps its files on the local filesystem, there is no
+    point in caching those.
+    """
+    try:
+        storage.path(name)
+    except NotImplementedError:
+        return False
+    return True
+
+
+class SourceCacheBase(object):
+    """
+    Source caches keep the bytes of source images from remote or slow storages
+    around, see ``THUMBNAIL_SOURCE_CACHE``.
+    """
+
+    def read(self, image_file):
+        """
+        Returns the contents of the ``image_file`` given
+        """
+        raise NotImplementedError()
+
+
+class DiskCache(SourceCacheBase):
+    """
+    Keeps sources in ``THUMBNAIL_SOURCE_CACHE_DIR`` up to
+    ``THUMBNAIL_SOURCE_CACHE_SIZE`` bytes, evicting the least recently used
+    ones. Every read checks with the storage whether the source has changed,
+    with a conditional request for urls and the modified time for others.
+    """
+
+    # The size of the cache is added up as sources are written, it is only
+    # walked when that goes over ``max_size`` or after this many writes, which
+    # catches up with what other processes wrote.
+    scan_interval = 1000
+
+    def __init__(self):
+        self.directory = (settings.THUMBNAIL_SOURCE_CACHE_DIR or
+                          os.path.join(tempfile.gettempdir(), 'sorl-thumbnail-sources'))
+        self.max_size = settings.THUMBNAIL_SOURCE_CACHE_SIZE
+        self.size = None
+        self.writes = 0
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def read(self, image_file):
+        storage, name = image_file.storage, image_file.name
+        if is_local(storage, name):
+            return storage.open(name).read()
+
+        path = self.path(image_file.key)
+        meta = self._get_meta(path)
+        data = None
+        if meta is not None:
+            data, meta = self._revalidate(storage, name, meta)
+            if data is None:
+                data = self._get(path)
+                if data is not None:
+                    return data
+        if data is None:
+            data, meta = self._fetch(storage, name)
+        self._set(path, data, meta)
+        return data
+
+    def _fetch(self, storage, name):
+        """
+        Returns the contents of the source and the metadata to revalidate it
+        """
+        fp = storage.open(name)
+        try:
+            return fp.read(), self._response_meta(storage, name, fp)
+        finally:
+            fp.close()
+
+    def _revalidate(self, storage, name, meta):
+        """
+        Returns ``(None, meta)`` when the cached source is still fresh,
+        otherwise its new contents and metadata
+        """
+        if hasattr(storage, 'open_if_modified'):
+            fp = storage.open_if_modified(name, meta.get('etag'),
+                                          meta.get('last_modified'))
+            if fp is None:
+                return None, meta
+            try:
+                return fp.read(), self._response_meta(storage, name, fp)
+            finally:
+                fp.close()
+
+        modified_time = self._modified_time(storage, name)
+        if modified_time is None or modified_time == meta.get('modified_time'):
+            return None, meta
+        return self._fetch(storage, name)
+
+    def _response_meta(self, storage, name, fp):
+        headers = getattr(fp, 'headers', None)
+        if headers is not None:
+            return {
+                'etag': headers.get('ETag'),
+                'last_modified': headers.get('Last-Modified'),
+            }
+        return {'modified_time': self._modified_time(storage, name)}
+
+    def _modified_time(self, storage, name):
+        try:
+            return storage.modified_time(name).isoformat()
+        except (NotImplementedError, AttributeError):
+            return None
+
+    def _get(self, path):
+        try:
+            with open(path, 'rb') as fp:
+                data = fp.read()
+            # Recently used sources are evicted last
+            os.utime(path, None)
+        except (IOError, OSError):
+            return None
+        return data
+
+    def _get_meta(self, path):
+        try:
+            with open(path + '.json') as fp:
+                return json.load(fp)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _set(self, path, data, meta):
+        directory = os.path.dirname(path)
+        try:
+            old_size = os.path.getsize(path)
+        except OSError:
+            old_size = 0
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            # Written to temporary files and moved in place so other processes
+            # never read a partial source.
+            for suffix, content in (('', data), ('.json', json.dumps(meta).encode('utf-8'))):
+                fd, tmp = tempfile.mkstemp(dir=directory)
+                with os.fdopen(fd, 'wb') as fp:
+                    fp.write(content)
+                os.rename(tmp, path + suffix)
+        except (IOError, OSError) as e:
+            logger.warn('Could not cache source [%s]: %s', path, e)
+            return
+
+        self.writes += 1
+        if self.size is not None:
+            self.size += len(data) - old_size
+        if (self.size is None or self.size > self.max_size or
+                self.writes >= self.scan_interval):
+            self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used sources until the cache fits in its
+        size
+        """
+        entries = []
+        total = 0
+        for directory, dirnames, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if filename.endswith('.json'):
+                    continue
+                path = os.path.join(directory, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_size:
+                break
+            for suffix in ('.json', ''):
+                try:
+                    os.remove(path + suffix)
+                except OSError:
+                    pass
+            total -= size
+        self.size = total
+        self.writes = 0
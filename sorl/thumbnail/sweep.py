@@ -0,0 +1,169 @@
+"""
+Finds thumbnail files that the key value store does not know about, see the
+``thumbnail sweep`` management command.
+"""
+import posixpath
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
+
+from sorl.thumbnail import default
+from sorl.thumbnail.conf import settings
+from sorl.thumbnail.helpers import chunks, ThumbnailError
+from sorl.thumbnail.images import ImageFile
+
+
+# Alternative resolutions are named after their thumbnail with ``@<ratio>x``
+# appended, only the thumbnail is in the key value store.
+alternative_pat = re.compile(r'^(.+)@[0-9.]+x(\.[^./]+)$')
+
+
+def get_prefix(prefix=None):
+    """
+    Returns the directory the thumbnails are in, ``THUMBNAIL_PREFIX`` by
+    default. Refuses the root of the storage, where everything that is not a
+    thumbnail would be deleted.
+    """
+    if prefix is None:
+        prefix = settings.THUMBNAIL_PREFIX
+    prefix = prefix.rstrip('/')
+    if not prefix.strip('/'):
+        raise ThumbnailError('Thumbnails are not kept in a directory of their own '
+                             '(THUMBNAIL_PREFIX is empty), there is nothing to '
+                             'sweep that is safe to delete.')
+    return prefix
+
+
+def thumbnail_names(storage, prefix=None):
+    """
+    Yields the names of the files in the ``THUMBNAIL_PREFIX`` directory of
+    ``storage``, one directory at a time.
+    """
+    prefix = get_prefix(prefix)
+    try:
+        directories = storage.listdir(prefix)[0]
+    except OSError:
+        # No thumbnails yet
+        return
+    # Thumbnails are two directories down, see ``_get_thumbnail_filename``
+    for first in sorted(directories):
+        for second in sorted(storage.listdir(posixpath.join(prefix, first))[0]):
+            directory = posixpath.join(prefix, first, second)
+            for name in sorted(storage.listdir(directory)[1]):
+                yield posixpath.join(directory, name)
+
+
+def referenced_name(name):
+    """
+    Returns the name of the thumbnail the file with ``name`` belongs to
+    """
+    match = alternative_pat.match(name)
+    if match:
+        return match.group(1) + match.group(2)
+    return name
+
+
+def find_orphans(names, storage):
+    """
+    Returns the names of the files given that are not thumbnails in the key
+    value store, looking them up in one go.
+    """
+    thumbnails = default.kvstore.get_many(
+        [ImageFile(referenced_name(name), storage) for name in names])
+    return [name for name, thumbnail in zip(names, thumbnails) if not thumbnail]
+
+
+class RateLimiter(object):
+    """
+    Lets at most ``rate`` calls to ``wait`` a second through, from any number
+    of threads. No limit when ``rate`` is not set.
+    """
+
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.time()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def sweep(storage=None, prefix=None, workers=1, chunk_size=None, min_age=3600,
+          rate=None, dry_run=False, report=None):
+    """
+    Deletes the files in the ``THUMBNAIL_PREFIX`` directory of ``storage``,
+    ``THUMBNAIL_STORAGE`` by default, that are not thumbnails in the key value
+    store. Files modified less than ``min_age`` seconds ago are kept, they may
+    be thumbnails that are being created. The files are looked up
+    ``chunk_size`` at a time and the orphans are deleted by ``workers`` threads,
+    at most ``rate`` a second. ``report`` is called with the stats and the
+    names of the orphans deleted after each chunk.
+
+    Returns the stats, a dict with the number of ``files`` checked,
+    ``orphans`` found and of those ``deleted``, or that would have been with
+    ``dry_run``, and the ``elapsed`` seconds.
+    """
+    if storage is None:
+        storage = default.storage
+    prefix = get_prefix(prefix)
+    chunk_size = chunk_size or settings.THUMBNAIL_KVSTORE_CHUNK_SIZE
+    limiter = RateLimiter(rate)
+    if min_age:
+        # Storages tell local times
+        cutoff = datetime.now() - timedelta(seconds=min_age)
+
+    def delete(name):
+        limiter.wait()
+        if min_age:
+            try:
+                if storage.modified_time(name) > cutoff:
+                    return False
+            except NotImplementedError:
+                pass
+        if not dry_run:
+            storage.delete(name)
+        return True
+
+    stats = dict(files=0, orphans=0, deleted=0, elapsed=0.0)
+    start = time.time()
+    executor = None
+    if workers > 1:
+        if ThreadPoolExecutor is None:
+            raise ThumbnailError('Sweeping with more than one worker requires '
+                                 'the futures backport.')
+        executor = ThreadPoolExecutor(workers)
+
+    try:
+        for names in chunks(thumbnail_names(storage, prefix), chunk_size):
+            orphans = find_orphans(names, storage)
+            if executor is not None:
+                results = list(executor.map(delete, orphans))
+            else:
+                results = [delete(name) for name in orphans]
+            deleted = [name for name, result in zip(orphans, results) if result]
+
+            stats['files'] += len(names)
+            stats['orphans'] += len(orphans)
+            stats['deleted'] += len(deleted)
+            stats['elapsed'] = time.time() - start
+            if report is not None:
+                report(stats, deleted)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    stats['elapsed'] = time.time() - start
+    return stats
@@ -15,13 +15,19 @@ from sorl.thumbnail import default
 from sorl.thumbnail.images import ImageFile, DummyImageFile
 from sorl.thumbnail.parsers import parse_geometry
 from sorl.thumbnail.compat import text_type
-from sorl.thumbnail.shortcuts import get_thumbnail
+from sorl.thumbnail.shortcuts import get_thumbnail, prefetch_thumbnails
 
 
 register = Library()
 kw_pat = re.compile(r'^(?P<key>[\w]+)=(?P<value>.+)$')
 logger = logging.getLogger('sorl.thumbnail')
 
+# Context variable holding the thumbnails found by ``thumbnail_prefetch``
+PREFETCHED_VAR = '_thumbnail_prefetched'
+# Context variable holding the content keys of the sources prefetched by key,
+# with ``THUMBNAIL_CONTENT_KEYS``
+CONTENT_KEYS_VAR = '_thumbnail_content_keys'
+
 
 def safe_filter(error_output=''):
     """
@@ -88,6 +94,36 @@ class ThumbnailNodeBase(Node):
         raise NotImplemented()
 
 
+def parse_options(parser, bits, error_msg):
+    """
+    Compiles ``key=value`` option bits, returns a list of (key, expr) pairs
+    """
+    options = []
+    for bit in bits:
+        m = kw_pat.match(bit)
+        if not m:
+            raise TemplateSyntaxError(error_msg)
+        key = smart_str(m.group('key'))
+        expr = parser.compile_filter(m.group('value'))
+        options.append((key, expr))
+    return options
+
+
+def resolve_options(options, context):
+    """
+    Resolves the compiled options in context, returns the options dict
+    """
+    resolved = {}
+    for key, expr in options:
+        noresolve = {'True': True, 'False': False, 'None': None}
+        value = noresolve.get(text_type(expr), expr.resolve(context))
+        if key == 'options':
+            resolved.update(value)
+        else:
+            resolved[key] = value
+    return resolved
+
+
 class ThumbnailNode(ThumbnailNodeBase):
     child_nodelists = ('nodelist_file', 'nodelist_empty')
     error_msg = ('Syntax error. Expected: ``thumbnail source geometry '
@@ -97,7 +133,6 @@ class ThumbnailNode(ThumbnailNodeBase):
         bits = token.split_contents()
         self.file_ = parser.compile_filter(bits[1])
         self.geometry = parser.compile_filter(bits[2])
-        self.options = []
         self.as_var = None
         self.nodelist_file = None
 
@@ -106,13 +141,7 @@ class ThumbnailNode(ThumbnailNodeBase):
         else:
             options_bits = bits[3:]
 
-        for bit in options_bits:
-            m = kw_pat.match(bit)
-            if not m:
-                raise TemplateSyntaxError(self.error_msg)
-            key = smart_str(m.group('key'))
-            expr = parser.compile_filter(m.group('value'))
-            self.options.append((key, expr))
+        self.options = parse_options(parser, options_bits, self.error_msg)
 
         if bits[-2] == 'as':
             self.as_var = bits[-1]
@@ -124,16 +153,21 @@ class ThumbnailNode(ThumbnailNodeBase):
     def _render(self, context):
         file_ = self.file_.resolve(context)
         geometry = self.geometry.resolve(context)
-        options = {}
-        for key, expr in self.options:
-            noresolve = {'True': True, 'False': False, 'None': None}
-            value = noresolve.get(text_type(expr), expr.resolve(context))
-            if key == 'options':
-                options.update(value)
-            else:
-                options[key] = value
-
-        thumbnail = get_thumbnail(file_, geometry, **options)
+        options = resolve_options(self.options, context)
+
+        thumbnail = None
+        prefetched = context.get(PREFETCHED_VAR)
+        if prefetched and file_:
+            source = ImageFile(file_)
+            content_keys = context.get(CONTENT_KEYS_VAR) or {}
+            source.content_key = content_keys.get(source.key)
+            # The name of a source that was not prefetched would cost a
+            # lookup of its content key on top of ``get_thumbnail``
+            if source.content_key is not None or not sorl_settings.THUMBNAIL_CONTENT_KEYS:
+                name = default.backend.get_thumbnail_name(source, geometry, **options)
+                thumbnail = prefetched.get(name)
+        if thumbnail is None:
+            thumbnail = get_thumbnail(file_, geometry, **options)
 
         if not thumbnail or (isinstance(thumbnail, DummyImageFile) and self.nodelist_empty):
             if self.nodelist_empty:
@@ -161,6 +195,40 @@ class ThumbnailNode(ThumbnailNodeBase):
             yield node
 
 
+class ThumbnailPrefetchNode(ThumbnailNodeBase):
+    error_msg = ('Syntax error. Expected: ``thumbnail_prefetch sources '
+                 'geometry [key1=val1 key2=val2...]``')
+
+    def __init__(self, parser, token):
+        bits = token.split_contents()
+        if len(bits) < 3:
+            raise TemplateSyntaxError(self.error_msg)
+        self.files = parser.compile_filter(bits[1])
+        self.geometry = parser.compile_filter(bits[2])
+        self.options = parse_options(parser, bits[3:], self.error_msg)
+
+    def _render(self, context):
+        files = self.files.resolve(context) or []
+        geometry = self.geometry.resolve(context)
+        options = resolve_options(self.options, context)
+
+        sources = [ImageFile(file_) for file_ in files if file_]
+        prefetched = dict(context.get(PREFETCHED_VAR) or {})
+        prefetched.update(prefetch_thumbnails(sources, geometry, **options))
+        context[PREFETCHED_VAR] = prefetched
+        if sorl_settings.THUMBNAIL_CONTENT_KEYS:
+            # Set on the sources by ``prefetch_thumbnails``, the ``thumbnail``
+            # tags need them for the names of the thumbnails
+            content_keys = dict(context.get(CONTENT_KEYS_VAR) or {})
+            content_keys.update((source.key, source.content_key) for source in sources
+                                if source.content_key is not None)
+            context[CONTENT_KEYS_VAR] = content_keys
+        return ''
+
+    def __repr__(self):
+        return "<ThumbnailPrefetchNode>"
+
+
 @register.filter
 def resolution(file_, resolution_string):
     """
@@ -175,6 +243,16 @@ def thumbnail(parser, token):
     return ThumbnailNode(parser, token)
 
 
+@register.tag
+def thumbnail_prefetch(parser, token):
+    """
+    Gets the thumbnails for all sources with geometry and options given from
+    the key value store in one go, ``thumbnail`` tags rendered later on in the
+    same context use them instead of looking them up one by one.
+    """
+    return ThumbnailPrefetchNode(parser, token)
+
+
 @safe_filter(error_output=False)
 @register.filter
 def is_portrait(file_):
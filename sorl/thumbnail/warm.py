@@ -0,0 +1,194 @@
+"""
+Creates the thumbnails of many images ahead of time, see the ``thumbnail
+warm`` management command.
+"""
+import logging
+import multiprocessing
+import posixpath
+import time
+
+from django.core.cache import cache
+from django.db import connections
+from django.utils.functional import empty
+from django.utils.text import smart_split
+from sorl.thumbnail import default
+from sorl.thumbnail.conf import settings
+from sorl.thumbnail.helpers import chunks, ThumbnailError
+from sorl.thumbnail.images import ImageFile
+from sorl.thumbnail.queues.base import make_job, run_job
+from sorl.thumbnail.templatetags.thumbnail import kw_pat
+
+
+logger = logging.getLogger(__name__)
+
+LITERALS = {'True': True, 'False': False, 'None': None}
+
+
+def parse_spec(spec):
+    """
+    Parses a thumbnail spec written like the arguments of the thumbnail tag,
+    ``'100x100 crop="center" quality=70'``, into a ``(geometry_string,
+    options)`` pair.
+    """
+    # Quoted values may have spaces, like ``crop="50% 50%"``
+    bits = list(smart_split(spec))
+    if not bits:
+        raise ThumbnailError('Empty thumbnail spec')
+
+    options = {}
+    for bit in bits[1:]:
+        m = kw_pat.match(bit)
+        if not m:
+            raise ThumbnailError('Bad thumbnail option `%s` in `%s`' % (bit, spec))
+        options[m.group('key')] = parse_value(m.group('value'))
+    return bits[0], options
+
+
+def parse_value(value):
+    if len(value) > 1 and value[0] == value[-1] and value[0] in '"\'':
+        return value[1:-1]
+    if value in LITERALS:
+        return LITERALS[value]
+    for type_ in (int, float):
+        try:
+            return type_(value)
+        except ValueError:
+            pass
+    return value
+
+
+def model_sources(model, field_name, batch_size=1000):
+    """
+    Yields the images of the ``field_name`` field of all ``model`` instances,
+    in order of primary key
+    """
+    field = model._meta.get_field(field_name)
+    queryset = model._default_manager.exclude(**{field_name: ''}) \
+        .exclude(**{'%s__isnull' % field_name: True}).order_by('pk')
+    last_pk = None
+    while True:
+        # Fetched in batches so the thumbnails can be written to the database
+        # in between
+        batch = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        rows = list(batch.values_list('pk', field_name)[:batch_size])
+        for pk, name in rows:
+            yield ImageFile(name, field.storage)
+        if len(rows) < batch_size:
+            break
+        last_pk = rows[-1][0]
+
+
+def storage_sources(storage, prefix=''):
+    """
+    Yields the images in the ``prefix`` directory of ``storage`` and all of its
+    subdirectories, except for the thumbnails
+    """
+    directories, files = storage.listdir(prefix)
+    for name in sorted(files):
+        yield ImageFile(posixpath.join(prefix, name), storage)
+    for directory in sorted(directories):
+        path = posixpath.join(prefix, directory)
+        if (path + '/').startswith(settings.THUMBNAIL_PREFIX):
+            continue
+        for source in storage_sources(storage, path):
+            yield source
+
+
+def find_missing(sources, thumbnail_specs):
+    """
+    Looks up the thumbnails of all ``sources`` for the ``(geometry_string,
+    options)`` pairs given in one go. Returns the number of thumbnails found and
+    ``make_job`` jobs for the ones missing.
+    """
+    missing = [[] for source in sources]
+    found = 0
+    for geometry_string, options in thumbnail_specs:
+        names = [default.backend.get_thumbnail_name(source, geometry_string, **options)
+                 for source in sources]
+        thumbnails = default.kvstore.get_many(
+            [ImageFile(name, default.storage) for name in names])
+        for source_missing, thumbnail in zip(missing, thumbnails):
+            if thumbnail:
+                found += 1
+            else:
+                source_missing.append((geometry_string, options))
+
+    jobs = [make_job(source, source_missing)
+            for source, source_missing in zip(sources, missing) if source_missing]
+    return found, jobs
+
+
+def create(job):
+    """
+    Runs a job from ``find_missing``, returns the number of thumbnails created
+    and failed.
+    """
+    try:
+        thumbnails = run_job(job)
+    except Exception:
+        logger.exception('Could not create thumbnails of [%s]', job['name'])
+        return 0, len(job['thumbnail_specs'])
+    created = len([thumbnail for thumbnail in thumbnails
+                   if isinstance(thumbnail, ImageFile) and thumbnail.size])
+    return created, len(thumbnails) - created
+
+
+def init_worker():
+    """
+    Runs first in each worker process. The key value store, lock and source
+    cache are set up again and the default cache reconnects, so the worker
+    does not share the sockets of its parent process, to memcached or Redis.
+    """
+    for obj in (default.kvstore, default.lock, default.source_cache):
+        obj._wrapped = empty
+    cache.close()
+
+
+def warm(sources, thumbnail_specs, workers=1, chunk_size=100, dry_run=False,
+         report=None):
+    """
+    Creates the thumbnails of ``sources`` for the ``(geometry_string,
+    options)`` pairs given that are not in the key value store yet, with a pool
+    of ``workers`` processes. The sources are looked up ``chunk_size`` at a time
+    and ``report`` is called with the stats after each chunk. Since thumbnails
+    that exist are skipped, running it again continues where it stopped.
+
+    Returns the stats, a dict with the number of ``sources``, thumbnails
+    ``found`` and ``missing``, thumbnails ``created`` and ``failed``, and the
+    ``elapsed`` seconds.
+    """
+    stats = dict(sources=0, found=0, missing=0, created=0, failed=0, elapsed=0.0)
+    start = time.time()
+    pool = None
+    if workers > 1 and not dry_run:
+        # Forked workers must not share database connections
+        for connection in connections.all():
+            connection.close()
+        pool = multiprocessing.Pool(workers, init_worker)
+
+    try:
+        for chunk in chunks(sources, chunk_size):
+            found, jobs = find_missing(chunk, thumbnail_specs)
+            stats['sources'] += len(chunk)
+            stats['found'] += found
+            stats['missing'] += sum(len(job['thumbnail_specs']) for job in jobs)
+
+            if not dry_run:
+                if pool is not None:
+                    results = pool.imap_unordered(create, jobs)
+                else:
+                    results = (create(job) for job in jobs)
+                for created, failed in results:
+                    stats['created'] += created
+                    stats['failed'] += failed
+
+            stats['elapsed'] = time.time() - start
+            if report is not None:
+                report(stats)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    stats['elapsed'] = time.time() - start
+    return stats
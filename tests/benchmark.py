@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+"""
+Micro-benchmarks of the work done for every thumbnail that is looked up,
+reported as microseconds per call.
+"""
+from __future__ import unicode_literals
+
+import os
+import sys
+import timeit
+from os.path import abspath, dirname, join as pjoin
+
+
+def setup(settings_module):
+    here = abspath(dirname(__file__))
+    root = pjoin(here, os.pardir)
+
+    sys.path[0:0] = [here, root, pjoin(root, 'sorl')]
+    os.environ['DJANGO_SETTINGS_MODULE'] = settings_module
+
+
+def keys(number):
+    from django.core.files.storage import default_storage
+    from sorl.thumbnail.base import ThumbnailBackend
+    from sorl.thumbnail.helpers import tokey
+    from sorl.thumbnail.images import ImageFile, deserialize_image_file
+
+    backend = ThumbnailBackend()
+    source = ImageFile('photos/2014/01/image.jpg', default_storage)
+    source.set_size((1600, 1200))
+    serialized = source.serialize()
+    options = backend._get_options(source, {'crop': 'center'})
+
+    def fresh_key():
+        ImageFile('photos/2014/01/image.jpg', default_storage).key
+
+    def deserialized_key():
+        deserialize_image_file(serialized).key
+
+    return [
+        ('tokey', lambda: tokey(source.name, 'storage.Storage')),
+        ('ImageFile.key, new image file', fresh_key),
+        ('ImageFile.key, deserialized', deserialized_key),
+        ('ImageFile.key, memoised', lambda: source.key),
+        ('_get_thumbnail_filename', lambda: backend._get_thumbnail_filename(
+            source, '100x100', options)),
+    ]
+
+
+def hits(number):
+    from django.core.files.storage import default_storage
+    from sorl.thumbnail import default, get_thumbnail
+    from sorl.thumbnail.conf import settings
+    from sorl.thumbnail.images import ImageFile
+    from sorl.thumbnail.kvstores.base import KVStoreBase
+
+    class MemoryKVStore(KVStoreBase):
+        """
+        Keeps the serialized values in a dict, so only the work sorl-thumbnail
+        does is timed
+        """
+
+        def __init__(self):
+            self.data = {}
+
+        def _get_raw(self, key):
+            return self.data.get(key)
+
+        def _set_raw(self, key, value):
+            self.data[key] = value
+
+        def _delete_raw(self, *keys):
+            for key in keys:
+                self.data.pop(key, None)
+
+        def _find_keys_raw(self, prefix):
+            return [key for key in self.data if key.startswith(prefix)]
+
+    default.kvstore._wrapped = MemoryKVStore()
+    source = ImageFile('photos/2014/01/image.jpg', default_storage)
+    source.set_size((1600, 1200))
+    default.kvstore.set(source)
+
+    specs = [('100x100', {'crop': 'center'}), ('400', {}), ('x50', {'quality': 70})]
+    for geometry_string, options in specs:
+        name = default.backend.get_thumbnail_name(source.name, geometry_string, **options)
+        thumbnail = ImageFile(name, default.storage)
+        thumbnail.set_size((100, 100))
+        default.kvstore.set(thumbnail, source)
+
+    def lookup():
+        for geometry_string, options in specs:
+            get_thumbnail(source.name, geometry_string, **options)
+
+    def lookups():
+        return default.backend.get_thumbnails(source.name, specs)
+
+    return [
+        ('get_thumbnail, hit (x%d)' % len(specs), lookup),
+        ('get_thumbnails, %d hits' % len(specs), lookups),
+    ]
+
+
+def run(benchmarks, number):
+    for name, func in benchmarks:
+        seconds = min(timeit.repeat(func, number=number, repeat=3))
+        sys.stdout.write('%-40s %8.2f us\n' % (name, seconds / number * 1e6))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Runs micro-benchmarks for sorl-thumbnail.'
+    )
+
+    parser.add_argument(
+        '--settings',
+        dest='settings_module',
+        action='store',
+        default='settings.default',
+        help='Specify settings module.')
+
+    parser.add_argument(
+        '--number',
+        dest='number',
+        action='store',
+        type=int,
+        default=10000,
+        help='Number of calls to time for each benchmark.')
+
+    args = parser.parse_args()
+
+    setup(args.settings_module)
+    run(keys(args.number) + hits(args.number), args.number)
@@ -1,6 +1,6 @@
 #/bin/bash
 
-for name in pil pgmagick imagemagick graphicsmagick wand redis
+for name in pil pgmagick imagemagick graphicsmagick wand vips redis
 do
     ./runtests.py --settings=settings.$name;
 done
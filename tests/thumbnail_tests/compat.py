@@ -8,3 +8,10 @@ if PY3:
     import unittest
 else:
     from django.utils import unittest
+
+if PY3:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+else:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
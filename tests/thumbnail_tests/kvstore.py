@@ -27,6 +27,10 @@ class TestKvStoreMixin(object):
         kvlog.log('get')
         return super(TestKvStoreMixin, self).get(*args, **kwargs)
 
+    def get_many(self, *args, **kwargs):
+        kvlog.log('get_many')
+        return super(TestKvStoreMixin, self).get_many(*args, **kwargs)
+
     def set(self, *args, **kwargs):
         kvlog.log('set')
         return super(TestKvStoreMixin, self).set(*args, **kwargs)
@@ -35,6 +39,14 @@ class TestKvStoreMixin(object):
         kvlog.log('delete')
         return super(TestKvStoreMixin, self).delete(*args, **kwargs)
 
+    def get_content_key(self, *args, **kwargs):
+        kvlog.log('get_content_key')
+        return super(TestKvStoreMixin, self).get_content_key(*args, **kwargs)
+
+    def get_content_keys(self, *args, **kwargs):
+        kvlog.log('get_content_keys')
+        return super(TestKvStoreMixin, self).get_content_keys(*args, **kwargs)
+
 
 class TestKVStore(TestKvStoreMixin, KVStore):
     pass
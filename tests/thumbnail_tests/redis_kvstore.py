@@ -0,0 +1,6 @@
+from sorl.thumbnail.kvstores.redis_kvstore import KVStore
+from .kvstore import TestKvStoreMixin
+
+
+class TestKVStore(TestKvStoreMixin, KVStore):
+    pass
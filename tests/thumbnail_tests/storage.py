@@ -75,3 +75,16 @@ class TestStorageMixin(object):
 
 class TestStorage(TestStorageMixin, FileSystemStorage):
     pass
+
+
+class BrokenStorage(FileSystemStorage):
+    """
+    Raises ``IOError`` opening the files named in ``broken``, whatever they
+    hold
+    """
+    broken = set()
+
+    def open(self, name, *args, **kwargs):
+        if name in self.broken:
+            raise IOError('Could not read %s' % name)
+        return super(BrokenStorage, self).open(name, *args, **kwargs)
@@ -2,34 +2,57 @@
 from __future__ import unicode_literals
 
 import sys
+import hashlib
+import json
 import logging
 from subprocess import Popen, PIPE
 
 import shutil
+import tempfile
+import threading
+import time
 import os
 import re
+import struct
 from os.path import join as pjoin
-from PIL import Image
-from django.utils.six import StringIO
+from PIL import Image, ImageChops
+from django.utils.six import BytesIO, StringIO
 from django.core import management
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
 from django.core.files.storage import default_storage
 from django.template.loader import render_to_string
 from django.test.client import Client
 from django.test import TestCase
 from django.test.utils import override_settings
-from sorl.thumbnail import default, get_thumbnail, delete
+from django.utils.datastructures import SortedDict
+from django.utils.functional import empty
+from sorl.thumbnail import default, get_thumbnail, get_thumbnails, delete
 from sorl.thumbnail.conf import settings
+from sorl.thumbnail.engines.convert_engine import Engine as ConvertEngine, escape
 from sorl.thumbnail.engines.pil_engine import Engine as PILEngine
-from sorl.thumbnail.helpers import get_module_class, ThumbnailError
-from sorl.thumbnail.images import ImageFile
+from sorl.thumbnail.helpers import get_module_class, ThumbnailError, tokey
+from sorl.thumbnail.images import ImageFile, DummyImageFile, get_pool, urllib3, \
+    deserialize_image_file
+from sorl.thumbnail.kvstores.base import ThreadPoolExecutor
+from sorl.thumbnail.kvstores.tiered_kvstore import LRUCache
+from sorl.thumbnail.locks.base import DummyLock, LockBase
+from sorl.thumbnail.queues.base import QueueBase, make_job, run_job
 from sorl.thumbnail.log import ThumbnailLogHandler
 from sorl.thumbnail.parsers import parse_crop, parse_geometry
+from sorl.thumbnail.sizes import probe_image_size
+from sorl.thumbnail.source_cache import DiskCache
 from sorl.thumbnail.templatetags.thumbnail import margin
+from sorl.thumbnail.sweep import sweep
+from sorl.thumbnail.warm import init_worker, parse_spec, storage_sources, \
+    warm as warm_thumbnails
 from sorl.thumbnail.base import ThumbnailBackend
 from .models import Item
-from .storage import MockLoggingHandler
-from .compat import unittest
+from .storage import BrokenStorage, MockLoggingHandler
+from .compat import unittest, HTTPServer, BaseHTTPRequestHandler, ThreadingMixIn
 from .utils import same_open_fd_count
+# the same module the THUMBNAIL_KVSTORE setting points to
+from thumbnail_tests.kvstore import kvlog
 
 
 skip = unittest.skip
@@ -85,6 +108,33 @@ class StorageTestCase(BaseStorageTestCase):
         self.assertEqual(self.log, [])
 
 
+class BatchStorageTestCase(BaseStorageTestCase):
+    name = 'batch.jpg'
+
+    def test_batch(self):
+        th1 = get_thumbnail(self.im, '20x20')
+        del self.log[:]
+        ths = get_thumbnails(self.im, [
+            ('50x50', {}),
+            ('20x20', {}),
+            ('30x10', {'crop': 'center'}),
+            ('50x50', {}),
+        ])
+        self.assertEqual([th.size for th in ths], [[50, 50], [20, 20], [30, 10], [50, 50]])
+        self.assertEqual(ths[1].name, th1.name)
+        self.assertEqual(ths[0].name, ths[3].name)
+        # the source is opened once for both missing thumbnails
+        self.assertEqual([a for a in self.log if a.startswith('open')], ['open: batch.jpg'])
+        self.assertEqual(len([a for a in self.log if a.startswith('save')]), 2)
+
+    def test_batch_cached(self):
+        get_thumbnails(self.im, [('40x40', {}), ('60x60', {'crop': 'center'})])
+        del self.log[:]
+        ths = get_thumbnails(self.im, [('60x60', {'crop': 'center'}), ('40x40', {})])
+        self.assertEqual([th.size for th in ths], [[60, 60], [40, 40]])
+        self.assertEqual(self.log, [])
+
+
 class AlternativeResolutionsTest(BaseStorageTestCase):
     name = 'retina.jpg'
 
@@ -116,12 +166,62 @@ class AlternativeResolutionsTest(BaseStorageTestCase):
             'get_available_name: test/cache/19/10/1910dc350bbe9ee55fd9d8d3d5e38e19@2x.jpg',
             'exists: test/cache/19/10/1910dc350bbe9ee55fd9d8d3d5e38e19@2x.jpg'
         ]
-        self.assertEqual(self.log, actions)
+        self.assertEqual(self.log[:4], actions[:4])
+        # The alternative resolutions are written at the same time
+        for name in ('@1.5x', '@2x'):
+            self.assertEqual([action for action in self.log if name in action],
+                             [action for action in actions if name in action])
 
         with open(pjoin(settings.MEDIA_ROOT, 'test/cache/19/10/1910dc350bbe9ee55fd9d8d3d5e38e19@1.5x.jpg')) as fp:
             engine = PILEngine()
             self.assertEqual(engine.get_image_size(engine.get_image(ImageFile(file_=fp))), (75, 75))
 
+    def test_retina_crop(self):
+        fn = pjoin(settings.MEDIA_ROOT, 'retina_crop.jpg')
+        image = Image.new('RGB', (200, 100), (0, 0, 255))
+        image.paste((255, 0, 0), (0, 0, 100, 100))
+        image.save(fn)
+
+        th = get_thumbnail('retina_crop.jpg', '40x30', crop='0px 0px')
+        engine = PILEngine()
+        for suffix, size in (('', (40, 30)), ('@1.5x', (60, 45)), ('@2x', (80, 60))):
+            name, ext = os.path.splitext(th.name)
+            image = Image.open(pjoin(settings.MEDIA_ROOT, name + suffix + ext))
+            self.assertEqual(image.size, size)
+            # Cropped from the red left half
+            red, green, blue = image.getpixel((size[0] // 2, size[1] // 2))
+            self.assertTrue(red > 200 and blue < 50, (suffix, red, blue))
+
+        th = get_thumbnail('retina_crop.jpg', '40x30', crop='center', rounded=5,
+                           format='PNG')
+        name, ext = os.path.splitext(th.name)
+        self.assertEqual(Image.open(pjoin(settings.MEDIA_ROOT, name + '@2x' + ext)).size,
+                         (80, 60))
+
+    def test_retina_convert(self):
+        # The images of the convert engine are the options that make them from
+        # the source, each resolution has to start from the source.
+        written = {}
+
+        class Engine(ConvertEngine):
+            def write(self, image, options, thumbnail):
+                written[thumbnail.name] = (image['options'].get('scale'),
+                                           image['options'].get('crop'))
+
+        source = {'source': 'retina.jpg', 'data': None, 'options': SortedDict(),
+                  'size': (200, 100), 'orientation': None, 'writes': None}
+        options = ThumbnailBackend()._get_options(self.im, {'crop': '0px 0px'})
+        default.engine._wrapped = Engine()
+        try:
+            ThumbnailBackend()._create_alternative_resolutions(
+                source, '40x30', options, 'test/retina.jpg')
+        finally:
+            default.engine._wrapped = empty
+        self.assertEqual(written, {
+            'test/retina@1.5x.jpg': ('90x45!', '60x45+0+0'),
+            'test/retina@2x.jpg': ('120x60!', '80x60+0+0'),
+        })
+
 
 class UrlStorageTestCase(unittest.TestCase):
     def test_encode_utf8_filenames(self):
@@ -132,6 +232,159 @@ class UrlStorageTestCase(unittest.TestCase):
         )
 
 
+class ImageRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    image = None
+    requests = []
+    ports = []
+
+    def do_HEAD(self):
+        self.requests.append(('HEAD', None))
+        self.ports.append(self.client_address[1])
+        if self.path == '/signed.jpg':
+            # Signed for GET only
+            self.send_response(403)
+        else:
+            self.send_response(200 if self.path == '/image.jpg' else 404)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        self.requests.append(('GET', self.headers.get('Range')))
+        self.ports.append(self.client_address[1])
+        if self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+        data = self.image
+        if self.path == '/truncated.jpg':
+            # Hang up halfway through the image
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data[:len(data) // 2])
+            self.close_connection = True
+            return
+        match = re.match(r'bytes=(\d+)-(\d+)', self.headers.get('Range') or '')
+        if match:
+            data = data[int(match.group(1)):int(match.group(2)) + 1]
+            self.send_response(206)
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('ETag', '"v1"')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class UrlStorageRequestsTestCase(unittest.TestCase):
+    def setUp(self):
+        fp = BytesIO()
+        Image.new('RGB', (200, 100)).save(fp, 'JPEG')
+        ImageRequestHandler.image = fp.getvalue()
+        ImageRequestHandler.requests = []
+        ImageRequestHandler.ports = []
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), ImageRequestHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%s/' % self.server.server_port
+        self.storage = get_module_class('sorl.thumbnail.images.UrlStorage')()
+
+    def tearDown(self):
+        if urllib3 is not None:
+            get_pool().clear()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def test_exists(self):
+        self.assertTrue(self.storage.exists(self.url + 'image.jpg'))
+        self.assertFalse(self.storage.exists(self.url + 'missing.jpg'))
+        self.assertEqual(ImageRequestHandler.requests, [('HEAD', None), ('HEAD', None)])
+
+    def test_exists_signed(self):
+        self.assertTrue(self.storage.exists(self.url + 'signed.jpg'))
+        self.assertEqual(ImageRequestHandler.requests, [('HEAD', None), ('GET', 'bytes=0-0')])
+
+    def test_image_size(self):
+        image = ImageFile(self.url + 'image.jpg')
+        image.set_size()
+        self.assertEqual(image.size, [200, 100])
+        self.assertEqual(ImageRequestHandler.requests, [('GET', 'bytes=0-262143')])
+
+    @skipIf(urllib3 is None, 'urllib3 is not installed')
+    def test_keep_alive(self):
+        name = self.url + 'image.jpg'
+        self.assertTrue(self.storage.exists(name))
+        self.storage.image_size(name)
+        self.assertEqual(self.storage.open(name).read(), ImageRequestHandler.image)
+        self.assertEqual(len(ImageRequestHandler.requests), 3)
+        self.assertEqual(len(set(ImageRequestHandler.ports)), 1)
+
+    @skipIf(urllib3 is None, 'urllib3 is not installed')
+    def test_truncated(self):
+        fp = self.storage.open(self.url + 'truncated.jpg')
+        try:
+            self.assertRaises(IOError, fp.read)
+        finally:
+            fp.close()
+
+    def test_source_cache_size(self):
+        directory = tempfile.mkdtemp()
+        settings.THUMBNAIL_SOURCE_CACHE_DIR = directory
+        try:
+            cache = DiskCache()
+            cache.max_size = 250
+            scans = []
+            evict = cache.evict
+            cache.evict = lambda: scans.append(cache.size) or evict()
+            for key in ('aa1', 'bb2', 'cc3'):
+                cache._set(cache.path(key), b'x' * 100, {})
+                if key == 'aa1':
+                    # least recently used
+                    os.utime(cache.path(key), (0, 0))
+            # only walked to find the size at first and once it is too big
+            self.assertEqual(scans, [None, 300])
+            self.assertEqual(cache.size, 200)
+            self.assertFalse(os.path.exists(cache.path('aa1')))
+            # replacing a source counts the difference
+            cache._set(cache.path('cc3'), b'x' * 50, {})
+            self.assertEqual(cache.size, 150)
+            self.assertEqual(len(scans), 2)
+        finally:
+            settings.THUMBNAIL_SOURCE_CACHE_DIR = None
+            shutil.rmtree(directory)
+
+    def test_source_cache(self):
+        directory = tempfile.mkdtemp()
+        settings.THUMBNAIL_SOURCE_CACHE = 'sorl.thumbnail.source_cache.DiskCache'
+        settings.THUMBNAIL_SOURCE_CACHE_DIR = directory
+        default.source_cache._wrapped = empty
+        try:
+            image = ImageFile(self.url + 'image.jpg')
+            self.assertEqual(image.read(), ImageRequestHandler.image)
+            self.assertEqual(image.read(), ImageRequestHandler.image)
+            self.assertTrue(os.path.exists(default.source_cache.path(image.key)))
+            # the second read only revalidated the cached source
+            self.assertEqual(ImageRequestHandler.requests, [('GET', None), ('GET', None)])
+
+            default.source_cache.max_size = 0
+            default.source_cache.evict()
+            self.assertFalse(os.path.exists(default.source_cache.path(image.key)))
+        finally:
+            settings.THUMBNAIL_SOURCE_CACHE = None
+            settings.THUMBNAIL_SOURCE_CACHE_DIR = None
+            default.source_cache._wrapped = empty
+            shutil.rmtree(directory)
+
+
 class ParsersTestCase(unittest.TestCase):
     def test_alias_crop(self):
         crop = parse_crop('center', (500, 500), (400, 400))
@@ -238,12 +491,12 @@ class SimpleTestCase(SimpleTestCaseBase):
         th3 = self.backend.get_thumbnail(im, '20x20')
         self.assertEqual(
             set([th1.key, th2.key, th3.key]),
-            set(self.kvstore._get(im.key, identity='thumbnails'))
+            set(self.kvstore._get_thumbnail_keys(im.key))
         )
         self.kvstore.delete_thumbnails(im)
         self.assertEqual(
-            None,
-            self.kvstore._get(im.key, identity='thumbnails')
+            [],
+            self.kvstore._get_thumbnail_keys(im.key)
         )
 
     def test_is_portrait(self):
@@ -269,6 +522,18 @@ class SimpleTestCase(SimpleTestCaseBase):
         self.kvstore.set(im)
         self.assertEqual(im.size, [500, 500])
 
+    def test_kvstore_get_many(self):
+        im1 = ImageFile(Item.objects.get(image='500x500.jpg').image)
+        im2 = ImageFile(Item.objects.get(image='100x100.jpg').image)
+        self.kvstore.delete(im1)
+        self.kvstore.delete(im2)
+        self.assertEqual(self.kvstore.get_many([im1, im2]), [None, None])
+        self.kvstore.set(im2)
+        cached = self.kvstore.get_many([im1, im2, im2])
+        self.assertEqual(cached[0], None)
+        self.assertEqual([im.size for im in cached[1:]], [[100, 100], [100, 100]])
+        self.assertEqual(self.kvstore.get_many([]), [])
+
     def test_cleanup1(self):
         im = ImageFile(Item.objects.get(image='500x500.jpg').image)
         self.kvstore.delete_thumbnails(im)
@@ -291,7 +556,7 @@ class SimpleTestCase(SimpleTestCaseBase):
         def keys_test(x, y, z):
             self.assertEqual(x, len(list(self.kvstore._find_keys(identity='image'))))
             self.assertEqual(y, len(list(self.kvstore._find_keys(identity='thumbnails'))))
-            self.assertEqual(z, len(self.kvstore._get(im.key, identity='thumbnails') or []))
+            self.assertEqual(z, len(self.kvstore._get_thumbnail_keys(im.key)))
 
         keys_test(3, 1, 2)
         th3.delete()
@@ -305,6 +570,40 @@ class SimpleTestCase(SimpleTestCaseBase):
         self.kvstore.clear()
         keys_test(0, 0, 0)
 
+    def test_cleanup_chunked(self):
+        self.kvstore.clear()
+        im = ImageFile(Item.objects.get(image='500x500.jpg').image)
+        th1 = self.backend.get_thumbnail(im, '27x27')
+        self.backend.get_thumbnail(im, '81x81')
+        th1.delete()
+        reports = []
+        # More than one worker needs the futures backport on Python 2
+        workers = 1 if ThreadPoolExecutor is None else 2
+        stats = self.kvstore.cleanup(workers=workers, chunk_size=1,
+                                     report=lambda stats: reports.append(dict(stats)))
+        self.assertEqual(stats, {'images': 3, 'deleted': 1, 'thumbnails': 1, 'stale': 1})
+        self.assertEqual(len(reports), 4)
+        self.assertEqual(self.kvstore.get(th1), None)
+        self.assertEqual(len(self.kvstore._get_thumbnail_keys(im.key)), 1)
+
+        # references to thumbnails of images that are gone are removed too
+        self.kvstore._delete(im.key)
+        self.assertEqual(self.kvstore.cleanup()['stale'], 1)
+        self.assertEqual(list(self.kvstore._find_keys(identity='thumbnails')), [])
+
+    def test_clear_chunked(self):
+        im = ImageFile(Item.objects.get(image='500x500.jpg').image)
+        self.backend.get_thumbnail(im, '27x27')
+        self.backend.get_thumbnail(im, '81x81')
+        chunk_size = settings.THUMBNAIL_KVSTORE_CHUNK_SIZE
+        settings.THUMBNAIL_KVSTORE_CHUNK_SIZE = 2
+        try:
+            self.kvstore.clear()
+        finally:
+            settings.THUMBNAIL_KVSTORE_CHUNK_SIZE = chunk_size
+        self.assertEqual(0, len(list(self.kvstore._find_keys(identity='image'))))
+        self.assertEqual(0, len(list(self.kvstore._find_keys(identity='thumbnails'))))
+
     def test_storage_serialize(self):
         im = ImageFile(Item.objects.get(image='500x500.jpg').image)
         self.assertEqual(im.serialize_storage(), 'thumbnail_tests.storage.TestStorage')
@@ -379,6 +678,205 @@ class SimpleTestCase(SimpleTestCaseBase):
         self.assertEqual('![A image!](/media/test/cache/2e/35/2e3517d8aa949728b1ee8b26c5a7bbc4.jpg)', val)
 
 
+@skipIf('redis_kvstore' not in settings.THUMBNAIL_KVSTORE, 'Redis only')
+class RedisKVStoreTestCase(SimpleTestCaseBase):
+    def test_thumbnails_set(self):
+        im = ImageFile(Item.objects.get(image='500x500.jpg').image)
+        self.kvstore.delete(im)
+        th1 = self.backend.get_thumbnail(im, '27x27')
+        th2 = self.backend.get_thumbnail(im, '81x81')
+        self.assertEqual(set(self.kvstore._get_thumbnail_keys(im.key)), set([th1.key, th2.key]))
+        self.kvstore._remove_thumbnail_keys(im.key, [th1.key])
+        self.assertEqual(self.kvstore._get_thumbnail_keys(im.key), [th2.key])
+        self.kvstore._remove_thumbnail_keys(im.key, [th2.key])
+        self.assertEqual(list(self.kvstore._find_keys(identity='thumbnails')), [])
+
+    def test_convert_thumbnails_list(self):
+        im = ImageFile(Item.objects.get(image='500x500.jpg').image)
+        self.kvstore.delete(im)
+        self.kvstore.set(im)
+        # the list of thumbnails as stored by earlier versions
+        self.kvstore._set(im.key, ['a', 'b'], identity='thumbnails')
+        th = self.backend.get_thumbnail(im, '27x27')
+        self.assertEqual(set(self.kvstore._get_thumbnail_keys(im.key)), set(['a', 'b', th.key]))
+        self.kvstore.cleanup()
+        self.assertEqual(self.kvstore._get_thumbnail_keys(im.key), [th.key])
+
+
+class TieredKVStoreTestCase(SimpleTestCaseBase):
+    def setUp(self):
+        super(TieredKVStoreTestCase, self).setUp()
+        tiered_kvstore = settings.THUMBNAIL_TIERED_KVSTORE
+        settings.THUMBNAIL_TIERED_KVSTORE = settings.THUMBNAIL_KVSTORE
+        try:
+            self.tiered = get_module_class('sorl.thumbnail.kvstores.tiered_kvstore.KVStore')()
+        finally:
+            settings.THUMBNAIL_TIERED_KVSTORE = tiered_kvstore
+
+    def test_cached(self):
+        im = ImageFile(Item.objects.get(image='500x500.jpg').image)
+        self.kvstore.delete(im)
+        self.tiered.set(im)
+        self.assertEqual(self.tiered.store.get(im).size, [500, 500])
+        # served from memory even though the store no longer has it
+        self.tiered.store.delete(im)
+        self.assertEqual(self.tiered.get(im).size, [500, 500])
+        self.assertEqual([i and i.size for i in self.tiered.get_many([im])], [[500, 500]])
+        self.tiered.delete(im)
+        self.assertEqual(self.tiered.get(im), None)
+
+    def test_thumbnails(self):
+        im = ImageFile(Item.objects.get(image='500x500.jpg').image)
+        self.kvstore.delete(im)
+        th = self.backend.get_thumbnail(im, '30x30')
+        self.assertEqual(self.tiered.get(th).size, [30, 30])
+        self.assertEqual(self.tiered._get_thumbnail_keys(im.key), [th.key])
+        self.tiered.delete_thumbnails(im)
+        self.assertEqual(self.tiered.get(th), None)
+
+    def test_lru(self):
+        cache = LRUCache(2, ttl=0.05)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual([cache.get(key) for key in 'abc'], [1, None, 3])
+        time.sleep(0.06)
+        self.assertEqual(cache.get('a'), None)
+
+
+class BrokenSourceTestCase(SimpleTestCaseBase):
+    def setUp(self):
+        super(BrokenSourceTestCase, self).setUp()
+        settings.THUMBNAIL_BROKEN_TIMEOUT = 60
+        # Fails reading the source with every engine
+        Image.new('L', (80, 80)).save(pjoin(settings.MEDIA_ROOT, 'broken.jpg'))
+        BrokenStorage.broken.add('broken.jpg')
+        self.source = ImageFile('broken.jpg', BrokenStorage())
+
+    def tearDown(self):
+        BrokenStorage.broken.clear()
+        settings.THUMBNAIL_BROKEN_TIMEOUT = None
+        default.kvstore.delete_broken()
+        super(BrokenSourceTestCase, self).tearDown()
+
+    def test_not_tried_again(self):
+        th = self.backend.get_thumbnail(self.source, '40x40')
+        self.assertFalse(th.exists())
+        self.assertTrue(default.kvstore.is_broken(self.source))
+
+        # fixed, but not tried again until the broken reference is gone
+        BrokenStorage.broken.clear()
+        th = self.backend.get_thumbnail(self.source, '40x40')
+        self.assertFalse(th.exists())
+
+        out = StringIO('')
+        management.call_command('thumbnail', 'clear_broken', verbosity=1, stdout=out)
+        self.assertEqual(out.getvalue(), "Forget images that could not be read ... [Done]\n")
+        self.assertFalse(default.kvstore.is_broken(self.source))
+        th = self.backend.get_thumbnail(self.source, '40x40')
+        self.assertTrue(th.exists())
+
+    def test_expires(self):
+        settings.THUMBNAIL_BROKEN_TIMEOUT = 0.05
+        self.backend.get_thumbnail(self.source, '40x40')
+        self.assertTrue(default.kvstore.is_broken(self.source))
+        time.sleep(0.06)
+        self.assertFalse(default.kvstore.is_broken(self.source))
+        default.kvstore.delete_broken(expired_only=True)
+        self.assertEqual(list(default.kvstore._find_keys(identity='broken')), [])
+
+
+class ContentKeysTestCase(SimpleTestCaseBase):
+    def setUp(self):
+        super(ContentKeysTestCase, self).setUp()
+        settings.THUMBNAIL_CONTENT_KEYS = True
+        shutil.copy(pjoin(settings.MEDIA_ROOT, '500x500.jpg'),
+                    pjoin(settings.MEDIA_ROOT, 'copy.jpg'))
+
+    def tearDown(self):
+        settings.THUMBNAIL_CONTENT_KEYS = False
+        super(ContentKeysTestCase, self).tearDown()
+
+    def test_shared(self):
+        im = ImageFile(Item.objects.get(image='500x500.jpg').image)
+        copy = ImageFile('copy.jpg', default_storage)
+        self.assertEqual(default.kvstore.get_content_key(im), im.digest())
+        th1 = self.backend.get_thumbnail(im, '33x33')
+        th2 = self.backend.get_thumbnail(copy, '33x33')
+        self.assertEqual(th1.name, th2.name)
+        self.assertNotEqual(th1.name, self.backend._get_thumbnail_filename(
+            ImageFile(Item.objects.get(image='100x100.jpg').image), '33x33',
+            self.backend._get_options(im, {})))
+
+        default.kvstore.delete(copy)
+        self.assertEqual(default.kvstore._get(copy.key, identity='content'), None)
+
+    def test_prefetch(self):
+        im = ImageFile(Item.objects.get(image='500x500.jpg').image)
+        copy = ImageFile('copy.jpg', default_storage)
+        th = self.backend.get_thumbnail(im, '34x34')
+        self.backend.get_thumbnail(copy, '34x34')
+
+        def get_content_key(image_file):
+            raise AssertionError('Content key of [%s] looked up on its own' % image_file.name)
+
+        # the content keys are looked up together
+        default.kvstore.get_content_key = get_content_key
+        try:
+            found = self.backend.prefetch_thumbnails([im, copy], '34x34')
+        finally:
+            del default.kvstore._wrapped.get_content_key
+        self.assertEqual(list(found), [th.name])
+
+    def test_prefetch_template(self):
+        images = [Item.objects.get(image=name).image
+                  for name in ('500x500.jpg', '100x100.jpg', '200x100.jpg')]
+        ths = [self.backend.get_thumbnail(image, '30x30', crop='center') for image in images]
+        kvlog.start_log()
+        val = render_to_string('thumbnail21.html', {
+            'images': images,
+        }).strip()
+        log = kvlog.stop_log()
+        self.assertEqual(val, ''.join('<img src="%s">' % th.url for th in ths))
+        # one lookup for the content keys and one for the thumbnails
+        self.assertEqual(log, ['get_content_keys', 'get_many'])
+
+    def test_missing(self):
+        missing = ImageFile('missing.jpg', default_storage)
+        self.assertEqual(self.backend._get_source_key(missing), missing.key)
+        self.assertEqual(default.kvstore._get(missing.key, identity='content'), None)
+
+
+class KeyTestCase(unittest.TestCase):
+    def tearDown(self):
+        settings.THUMBNAIL_KEY_HASH = 'md5'
+
+    def test_memoised(self):
+        im = ImageFile('500x500.jpg', default_storage)
+        key = im.key
+        self.assertEqual(key, tokey('500x500.jpg', im.serialize_storage()))
+        im.name = 'other.jpg'
+        self.assertNotEqual(im.key, key)
+        self.assertEqual(ImageFile('other.jpg', default_storage).key, im.key)
+
+    def test_deserialized(self):
+        im = ImageFile('500x500.jpg', default_storage)
+        im.set_size((500, 500))
+        deserialized = deserialize_image_file(im.serialize())
+        self.assertEqual(deserialized.key, im.key)
+        # the storage is not set up just for the key
+        self.assertTrue(deserialized.storage._wrapped is empty)
+        # once set up it is the storage it was serialized with
+        self.assertEqual(deserialized.storage.path('a.jpg'), default_storage.path('a.jpg'))
+
+    def test_hash(self):
+        settings.THUMBNAIL_KEY_HASH = 'sha1'
+        self.assertEqual(tokey('a', 'b'), hashlib.sha1(b'a||b').hexdigest())
+        settings.THUMBNAIL_KEY_HASH = 'nohash'
+        self.assertRaises(ImproperlyConfigured, tokey, 'a', 'b')
+
+
 class TemplateTestCaseA(SimpleTestCaseBase):
     def test_model(self):
         item = Item.objects.get(image='500x500.jpg')
@@ -402,6 +900,19 @@ class TemplateTestCaseA(SimpleTestCaseBase):
             '</a>')
         )
 
+    def test_prefetch(self):
+        images = [Item.objects.get(image=name).image
+                  for name in ('500x500.jpg', '100x100.jpg', '200x100.jpg')]
+        ths = [self.backend.get_thumbnail(image, '30x30', crop='center') for image in images]
+        kvlog.start_log()
+        val = render_to_string('thumbnail21.html', {
+            'images': images,
+        }).strip()
+        log = kvlog.stop_log()
+        self.assertEqual(val, ''.join('<img src="%s">' % th.url for th in ths))
+        # one lookup for all the thumbnails
+        self.assertEqual(log, ['get_many'])
+
     def test_serialization_options(self):
         item = Item.objects.get(image='500x500.jpg')
 
@@ -475,6 +986,142 @@ class TemplateTestCaseA(SimpleTestCaseBase):
                 self.assertEqual(exif.get(0x0112), 1)
 
 
+class BusyLock(LockBase):
+    def acquire(self, key):
+        return False
+
+    def release(self, key):
+        raise AssertionError('Releasing a lock that was never acquired')
+
+
+class RacingLock(LockBase):
+    """
+    Lets another process create the thumbnail and release its lock just before
+    the lock is acquired
+    """
+
+    def __init__(self, create):
+        self.create = create
+
+    def acquire(self, key):
+        create, self.create = self.create, None
+        if create is not None:
+            create()
+        return True
+
+    def release(self, key):
+        pass
+
+
+class CountingBackend(ThumbnailBackend):
+    def __init__(self):
+        self.created = []
+
+    def _create_thumbnails(self, file_, source, thumbnail_specs):
+        self.created.extend(thumbnail.name for thumbnail, geometry_string, options
+                            in thumbnail_specs)
+        return super(CountingBackend, self)._create_thumbnails(
+            file_, source, thumbnail_specs)
+
+
+class LockTestCase(SimpleTestCaseBase):
+    def test_locks(self):
+        for lock_class in ('sorl.thumbnail.locks.cache_lock.Lock',
+                           'sorl.thumbnail.locks.file_lock.Lock'):
+            lock = get_module_class(lock_class)()
+            self.assertTrue(lock.acquire('abc'))
+            self.assertFalse(lock.acquire('abc'))
+            self.assertTrue(lock.acquire('def'))
+            lock.release('abc')
+            self.assertTrue(lock.acquire('abc'))
+            lock.release('abc')
+            lock.release('def')
+
+    def test_file_lock_expires(self):
+        lock = get_module_class('sorl.thumbnail.locks.file_lock.Lock')()
+        self.assertTrue(lock.acquire('abc'))
+        os.utime(lock.path('abc'), (0, 0))
+        self.assertTrue(lock.acquire('abc'))
+        lock.release('abc')
+
+    def test_locked_out(self):
+        im = ImageFile(Item.objects.get(image='500x500.jpg').image)
+        self.kvstore.delete_thumbnails(im)
+        th = self.backend.get_thumbnail(im, '40x40')
+        default.lock._wrapped = BusyLock()
+        wait = settings.THUMBNAIL_LOCK_WAIT
+        settings.THUMBNAIL_LOCK_WAIT = 0
+        try:
+            # cached thumbnails are not affected
+            self.assertEqual(self.backend.get_thumbnail(im, '40x40').name, th.name)
+            placeholder = self.backend.get_thumbnail(im, '41x41')
+        finally:
+            settings.THUMBNAIL_LOCK_WAIT = wait
+            default.lock._wrapped = empty
+        self.assertTrue(isinstance(placeholder, DummyImageFile))
+        self.assertEqual(placeholder.size, (41, 41))
+
+    def test_lost_race(self):
+        im = ImageFile(Item.objects.get(image='500x500.jpg').image)
+        self.kvstore.delete_thumbnails(im)
+        backend = CountingBackend()
+        default.lock._wrapped = RacingLock(lambda: backend.get_thumbnail(im, '42x42'))
+        try:
+            th = backend.get_thumbnail(im, '42x42')
+        finally:
+            default.lock._wrapped = empty
+        # created once, by the winner
+        self.assertEqual(backend.created, [th.name])
+        self.assertEqual(tuple(th.size), (42, 42))
+
+    def test_dummy_lock(self):
+        im = ImageFile(Item.objects.get(image='500x500.jpg').image)
+        self.kvstore.delete_thumbnails(im)
+        default.lock._wrapped = DummyLock()
+        kvlog.start_log()
+        try:
+            self.backend.get_thumbnail(im, '43x43')
+        finally:
+            log = kvlog.stop_log()
+            default.lock._wrapped = empty
+        # no lookup again since no one else can hold the lock
+        self.assertEqual(log.count('get_many'), 1)
+
+
+class ImmediateQueue(QueueBase):
+    jobs = []
+
+    def enqueue(self, source, thumbnail_specs):
+        self.jobs.append(json.loads(json.dumps(make_job(source, thumbnail_specs))))
+
+
+class QueueTestCase(SimpleTestCaseBase):
+    def setUp(self):
+        super(QueueTestCase, self).setUp()
+        settings.THUMBNAIL_QUEUE = 'thumbnail_tests.tests.ImmediateQueue'
+        default.queue._wrapped = ImmediateQueue()
+
+    def tearDown(self):
+        super(QueueTestCase, self).tearDown()
+        settings.THUMBNAIL_QUEUE = None
+        default.queue._wrapped = empty
+
+    def test_queued(self):
+        im = ImageFile(Item.objects.get(image='500x500.jpg').image)
+        self.kvstore.delete_thumbnails(im)
+        th1, th2 = self.backend.get_thumbnails(im, [('42x42', {}), ('43x43', {'crop': 'center'})])
+        self.assertTrue(isinstance(th1, DummyImageFile))
+        self.assertTrue(isinstance(th2, DummyImageFile))
+        self.assertEqual(len(default.queue.jobs), 1)
+
+        run_job(default.queue.jobs.pop())
+        th1, th2 = self.backend.get_thumbnails(im, [('42x42', {}), ('43x43', {'crop': 'center'})])
+        self.assertEqual(th1.size, [42, 42])
+        self.assertEqual(th2.size, [43, 43])
+        self.assertTrue(th2.exists())
+        self.assertEqual(default.queue.jobs, [])
+
+
 class TemplateTestCaseB(unittest.TestCase):
     def tearDown(self):
         try:
@@ -612,6 +1259,308 @@ class CropTestCase(unittest.TestCase):
         shutil.rmtree(settings.MEDIA_ROOT)
 
 
+class DraftTestCase(unittest.TestCase):
+    def setUp(self):
+        if not os.path.exists(settings.MEDIA_ROOT):
+            os.makedirs(settings.MEDIA_ROOT)
+        self.name = 'draft.jpg'
+        Image.new('RGB', (1600, 1200), (255, 0, 0)).save(
+            pjoin(settings.MEDIA_ROOT, self.name))
+        self.engine = PILEngine()
+
+    def get_image(self):
+        return self.engine.get_image(ImageFile(self.name))
+
+    def test_draft(self):
+        image = self.engine.draft(self.get_image(), [((100, 75), {'crop': False})])
+        self.assertEqual(image.size, (200, 150))
+        image = self.engine.create(image, (100, 75), {
+            'cropbox': None, 'colorspace': 'RGB', 'upscale': False,
+            'crop': False, 'rounded': None})
+        self.assertEqual(image.size, (100, 75))
+
+    def test_draft_largest_target(self):
+        targets = [((100, 75), {'crop': False}), ((400, 300), {'crop': False})]
+        image = self.engine.draft(self.get_image(), targets)
+        self.assertEqual(image.size, (800, 600))
+
+    def test_no_draft(self):
+        image = self.engine.draft(self.get_image(), [((1000, 750), {'crop': False})])
+        self.assertEqual(image.size, (1600, 1200))
+        image = self.engine.draft(self.get_image(), [
+            ((100, 75), {'crop': False, 'cropbox': '0,0,200,150'})])
+        self.assertEqual(image.size, (1600, 1200))
+
+    def test_thumbnail(self):
+        th = get_thumbnail(self.name, '100x100', crop='center')
+        self.assertEqual(th.x, 100)
+        self.assertEqual(th.y, 100)
+        self.assertEqual(Image.open(th.storage.path(th.name)).getpixel((50, 50))[:1], (254,))
+
+    def test_draft_size(self):
+        # A draft is rounded to a multiple of 8 pixels, the thumbnails have the
+        # size they would have from the full source whatever they are made with
+        Image.new('RGB', (3000, 2001)).save(pjoin(settings.MEDIA_ROOT, 'draft_size.jpg'))
+        ths = get_thumbnails('draft_size.jpg', [('200', {}), ('150', {}), ('x40', {})])
+        self.assertEqual([(th.x, th.y) for th in ths], [(199, 133), (150, 100), (60, 40)])
+
+    def test_thumbnails(self):
+        # Both are made from the same draft
+        ths = get_thumbnails(self.name, [('100x100', {}), ('50x50', {'crop': 'center'})])
+        self.assertEqual([(th.x, th.y) for th in ths], [(100, 75), (50, 50)])
+        for th in ths:
+            self.assertEqual(Image.open(th.storage.path(th.name)).size, (th.x, th.y))
+
+    def test_retina(self):
+        settings.THUMBNAIL_ALTERNATIVE_RESOLUTIONS = [1.5, 2]
+        try:
+            th = get_thumbnail(self.name, '120x120', crop='center')
+        finally:
+            settings.THUMBNAIL_ALTERNATIVE_RESOLUTIONS = []
+        name, ext = os.path.splitext(th.storage.path(th.name))
+        for suffix, size in (('', (120, 120)), ('@1.5x', (180, 180)), ('@2x', (240, 240))):
+            self.assertEqual(Image.open(name + suffix + ext).size, size)
+
+    def tearDown(self):
+        shutil.rmtree(settings.MEDIA_ROOT)
+
+
+class PlanTestCaseBase(unittest.TestCase):
+    """
+    ``create`` orients, converts, scales and crops in the order that is the
+    least work, which must look the same as doing it step by step.
+    """
+
+    def setUp(self):
+        if not os.path.exists(settings.MEDIA_ROOT):
+            os.makedirs(settings.MEDIA_ROOT)
+
+    def save(self, name, mode, orientation=None):
+        red = Image.linear_gradient('L').resize((300, 200))
+        green = Image.radial_gradient('L').resize((300, 200))
+        blue = red.transpose(Image.FLIP_LEFT_RIGHT)
+        image = Image.merge('RGB', (red, green, blue)).convert(mode)
+        params = {'quality': 95}
+        if orientation:
+            # A little endian TIFF header with just the orientation tag
+            params['exif'] = (b'Exif\x00\x00II*\x00' + struct.pack('<IH', 8, 1) +
+                              struct.pack('<HHIHHI', 0x0112, 3, 1, orientation, 0, 0))
+        image.save(pjoin(settings.MEDIA_ROOT, name), **params)
+        return name
+
+    def reference(self, image, geometry, options):
+        # The steps of ``create`` one after the other
+        for step in (self.engine.cropbox, self.engine.orientation,
+                     self.engine.colorspace, self.engine.scale, self.engine.crop):
+            image = step(image, geometry, options)
+        return image
+
+    def assertSameThumbnail(self, name, geometry, **options):
+        options = dict({'cropbox': None, 'colorspace': 'RGB', 'upscale': False,
+                        'crop': False, 'rounded': None, 'blur': None,
+                        'padding': False}, **options)
+        image = self.engine.create(
+            self.engine.get_image(ImageFile(name)), geometry, options)
+        expected = self.reference(
+            self.engine.get_image(ImageFile(name)), geometry, options)
+        self.assertEqual(self.engine.get_image_size(image),
+                         self.engine.get_image_size(expected))
+        # Resampling just the cropped box may round a few pixels the other way
+        difference = self.get_difference(image, expected)
+        self.assertTrue(difference <= 1, (name, geometry, options, difference))
+
+    def tearDown(self):
+        shutil.rmtree(settings.MEDIA_ROOT)
+
+
+class PlanTestCase(PlanTestCaseBase):
+    def setUp(self):
+        super(PlanTestCase, self).setUp()
+        self.engine = PILEngine()
+
+    def get_difference(self, image, expected):
+        self.assertEqual(image.mode, expected.mode)
+        extrema = ImageChops.difference(image, expected).getextrema()
+        if image.mode == 'L':
+            extrema = [extrema]
+        return max(high for low, high in extrema)
+
+    def test_plan(self):
+        options = {'crop': 'center', 'upscale': True}
+        self.assertEqual(self.engine.plan(Image.new('RGB', (300, 200)), (100, 100), options),
+                         {'scale': (150, 100), 'crop': (100, 100, 25, 0),
+                          'box': (50.0, 0.0, 250.0, 200.0)})
+        self.assertEqual(self.engine.plan(Image.new('RGB', (300, 200)), (100, 100), options,
+                                          transposed=True),
+                         {'scale': (150, 100), 'crop': (100, 100, 0, 25), 'box': None})
+        options = {'crop': False, 'upscale': False}
+        self.assertEqual(self.engine.plan(Image.new('RGB', (300, 200)), (400, 400), options),
+                         {'scale': None, 'crop': None, 'box': None})
+
+    def test_same_thumbnail(self):
+        geometries = [(100, 100), (100, 50), (50, 100), (600, 600), (300, 200)]
+        crops = [False, 'center', 'top', '10% 80%', 'noop']
+        for mode in ('RGB', 'L'):
+            name = self.save('plan_%s.jpg' % mode, mode)
+            for geometry in geometries:
+                for crop in crops:
+                    for upscale in (False, True):
+                        self.assertSameThumbnail(name, geometry, crop=crop, upscale=upscale)
+            self.assertSameThumbnail(name, (100, 100), colorspace='GRAY')
+            self.assertSameThumbnail(name, (100, 100), cropbox='10,10,210,110', crop='center')
+
+    def test_same_orientation(self):
+        for orientation in range(1, 9):
+            name = self.save('plan_%s.jpg' % orientation, 'RGB', orientation)
+            for geometry in ((100, 100), (50, 100), (100, 50)):
+                for crop in (False, 'center', 'left'):
+                    self.assertSameThumbnail(name, geometry, crop=crop)
+            image = self.engine.create(self.engine.get_image(ImageFile(name)), (100, 100), {
+                'cropbox': None, 'colorspace': 'RGB', 'upscale': False, 'crop': False,
+                'rounded': None})
+            if orientation > 4:
+                self.assertEqual(image.size, (67, 100))
+            else:
+                self.assertEqual(image.size, (100, 67))
+
+
+@skipIf('vips_engine' not in settings.THUMBNAIL_ENGINE, 'vips only')
+class VipsPlanTestCase(PlanTestCaseBase):
+    def setUp(self):
+        super(VipsPlanTestCase, self).setUp()
+        self.engine = get_module_class(settings.THUMBNAIL_ENGINE)()
+
+    def get_difference(self, image, expected):
+        self.assertEqual(image.interpretation, expected.interpretation)
+        self.assertEqual(image.bands, expected.bands)
+        return (image - expected).abs().max()
+
+    def test_same_colorspace(self):
+        # Black and white sources are made sRGB after scaling
+        name = self.save('plan_L.jpg', 'L')
+        for geometry in ((100, 100), (50, 100)):
+            for crop in (False, 'center'):
+                self.assertSameThumbnail(name, geometry, crop=crop)
+                self.assertSameThumbnail(name, geometry, crop=crop, colorspace='GRAY')
+
+    def test_same_orientation(self):
+        for orientation in range(1, 9):
+            name = self.save('plan_%s.jpg' % orientation, 'RGB', orientation)
+            for geometry in ((100, 100), (50, 100)):
+                for crop in (False, 'center'):
+                    self.assertSameThumbnail(name, geometry, crop=crop)
+
+
+class SizeProbeTestCase(unittest.TestCase):
+    def probe(self, format_, size=(123, 45), **params):
+        fp = BytesIO()
+        Image.new('RGB', size).save(fp, format_, **params)
+        fp.seek(0)
+        return probe_image_size(fp)
+
+    def test_formats(self):
+        self.assertEqual(self.probe('JPEG'), (123, 45))
+        self.assertEqual(self.probe('JPEG', progressive=True), (123, 45))
+        self.assertEqual(self.probe('PNG'), (123, 45))
+        self.assertEqual(self.probe('GIF'), (123, 45))
+
+    @skipIf('WEBP' not in Image.SAVE, 'Pillow has no WebP support')
+    def test_webp(self):
+        self.assertEqual(self.probe('WEBP'), (123, 45))
+        self.assertEqual(self.probe('WEBP', lossless=True), (123, 45))
+
+    def test_large_header(self):
+        exif = b'Exif\x00\x00' + b'\x00' * 60000
+        self.assertEqual(self.probe('JPEG', (1000, 2000), exif=exif), (1000, 2000))
+
+    def test_unknown(self):
+        self.assertEqual(probe_image_size(BytesIO(b'BM' + b'\x00' * 100)), None)
+        self.assertEqual(probe_image_size(BytesIO(b'\xff\xd8\xff\xe0\x00')), None)
+        self.assertEqual(probe_image_size(BytesIO(b'')), None)
+
+    def test_set_size(self):
+        os.makedirs(settings.MEDIA_ROOT)
+        try:
+            Image.new('RGB', (64, 32)).save(pjoin(settings.MEDIA_ROOT, 'probe.png'))
+            image = ImageFile('probe.png')
+            image.set_size()
+            self.assertEqual(image.size, [64, 32])
+        finally:
+            shutil.rmtree(settings.MEDIA_ROOT)
+
+
+class RecordingConvertEngine(ConvertEngine):
+    def __init__(self):
+        self.runs = []
+
+    def _run(self, command, args, input=None):
+        self.runs.append((args, input))
+        for i, arg in enumerate(args):
+            if arg == '-write':
+                with open(args[i + 1], 'wb') as fp:
+                    fp.write(b'thumbnail')
+        return 0, b'thumbnail', b''
+
+
+class ConvertEngineTestCase(unittest.TestCase):
+    def setUp(self):
+        settings.THUMBNAIL_CONVERT_CHAIN = True
+        self.engine = RecordingConvertEngine()
+
+    def tearDown(self):
+        settings.THUMBNAIL_CONVERT_CHAIN = False
+        if os.path.exists(settings.MEDIA_ROOT):
+            shutil.rmtree(settings.MEDIA_ROOT)
+
+    def test_chain(self):
+        options = {'format': 'JPEG', 'quality': 90, 'image_info': {}}
+        source = self.engine.get_image(StringIO(b'xxx'))
+        source['size'] = (100, 100)
+        thumbnails = []
+        try:
+            for size in (50, 25):
+                image = self.engine.copy_image(source)
+                image = self.engine._scale(image, size, size)
+                thumbnail = ImageFile('chain_%s.jpg' % size, default.storage)
+                self.engine.write(image, options, thumbnail)
+                thumbnails.append(thumbnail)
+            self.assertEqual(self.engine.runs, [])
+            self.engine.flush(source)
+        finally:
+            self.engine.cleanup(source)
+
+        self.assertEqual(len(self.engine.runs), 1)
+        args, input = self.engine.runs[0]
+        self.assertEqual(args[0], '-respect-parentheses')
+        self.assertEqual(args[-1], 'null:')
+        self.assertEqual(args.count('+clone'), 2)
+        self.assertTrue('50x50!' in args)
+        self.assertTrue('25x25!' in args)
+        for thumbnail in thumbnails:
+            self.assertEqual(thumbnail.read(), b'thumbnail')
+
+    def test_pipe(self):
+        settings.THUMBNAIL_CONVERT_CHAIN = False
+        settings.THUMBNAIL_CONVERT_PIPE = True
+        try:
+            image = self.engine.get_image(StringIO(b'xxx'))
+            thumbnail = ImageFile('pipe.jpg', default.storage)
+            self.engine.write(image, {'format': 'JPEG', 'quality': 90, 'image_info': {}},
+                              thumbnail)
+            self.engine.cleanup(image)
+        finally:
+            settings.THUMBNAIL_CONVERT_PIPE = False
+
+        args, input = self.engine.runs[0]
+        self.assertEqual(args[0], '-[0]')
+        self.assertEqual(args[-1], 'jpg:-')
+        self.assertEqual(input, b'xxx')
+        self.assertEqual(thumbnail.read(), b'thumbnail')
+
+    def test_batch_escape(self):
+        self.assertEqual(escape('/tmp/a b"c\'d.jpg'), '/tmp/a\\ b\\"c\\\'d.jpg')
+
+
 class DummyTestCase(TestCase):
     def setUp(self):
         self.backend = get_module_class(settings.THUMBNAIL_BACKEND)()
@@ -674,6 +1623,30 @@ class BackendTest(SimpleTestCaseBase):
         self.assertTrue(ImageFile(im2).exists())
 
 
+class FilenameTestCase(SimpleTestCaseBase):
+    def test_remembered(self):
+        im = ImageFile(Item.objects.get(image='500x500.jpg').image)
+        options = {'crop': 'center'}
+        name = self.backend.get_thumbnail_name(im, '30x30', **options)
+        self.assertEqual(self.backend.get_thumbnail_name(im, '30x30', **options), name)
+        self.assertEqual(ThumbnailBackend().get_thumbnail_name(im, '30x30', **options), name)
+        self.assertEqual(options, {'crop': 'center'})
+
+    def test_equal_options(self):
+        im = ImageFile(Item.objects.get(image='500x500.jpg').image)
+        # equal values that serialize differently get their own filenames
+        for key, first, second in (('upscale', True, 1), ('quality', 80, 80.0)):
+            self.backend.get_thumbnail_name(im, '30x30', **{key: first})
+            self.assertEqual(self.backend.get_thumbnail_name(im, '30x30', **{key: second}),
+                             ThumbnailBackend().get_thumbnail_name(im, '30x30', **{key: second}))
+
+    def test_unhashable(self):
+        im = ImageFile(Item.objects.get(image='500x500.jpg').image)
+        name = self.backend.get_thumbnail_name(im, '30x30', extra=[1, 2])
+        self.assertEqual(self.backend.get_thumbnail_name(im, '30x30', extra=[1, 2]), name)
+        self.assertNotEqual(self.backend.get_thumbnail_name(im, '30x30'), name)
+
+
 class TestInputCase(unittest.TestCase):
     def setUp(self):
         if not os.path.exists(settings.MEDIA_ROOT):
@@ -736,6 +1709,85 @@ class CommandTests(SimpleTestCase):
         management.call_command('thumbnail', 'cleanup', verbosity=1, stdout=out)
         self.assertEqual(out.getvalue(), "Cleanup thumbnails ... [Done]\n")
 
+    def test_warm_action(self):
+        for item in Item.objects.all():
+            default.kvstore.delete(ImageFile(item.image))
+        call = lambda **options: management.call_command(
+            'thumbnail', 'warm', model='thumbnail_tests.Item', field='image',
+            specs=['17x17', '19x19 crop="center" quality=70'], verbosity=1,
+            stdout=out, **options)
+
+        out = StringIO('')
+        call(dry_run=True)
+        self.assertIn('6 thumbnails would be created', out.getvalue())
+
+        out = StringIO('')
+        call(chunk_size=2)
+        self.assertIn('3 images, 0 thumbnails found, 6 missing, 6 created, 0 failed', out.getvalue())
+        im = ImageFile(Item.objects.get(image='500x500.jpg').image)
+        self.assertEqual(get_thumbnail(im, '19x19', crop='center', quality=70).size, [19, 19])
+
+        # continues where it stopped
+        out = StringIO('')
+        call()
+        self.assertIn('3 images, 6 thumbnails found, 0 missing', out.getvalue())
+
+    def test_warm_prefix(self):
+        get_thumbnail(Item.objects.get(image='100x100.jpg').image, '100x100')
+        thumbnail_specs = [('23x23', {})]
+        stats = warm_thumbnails(storage_sources(default_storage), thumbnail_specs)
+        # without the thumbnail made above
+        self.assertEqual(stats['sources'], 3)
+        self.assertEqual(stats['created'], 3)
+        stats = warm_thumbnails(storage_sources(default_storage), thumbnail_specs)
+        self.assertEqual(stats['found'], 3)
+
+    def test_sweep_action(self):
+        im = ImageFile(Item.objects.get(image='500x500.jpg').image)
+        th = self.backend.get_thumbnail(im, '29x29')
+        alternative = th.name.replace('.jpg', '@2x.jpg')
+        orphan = settings.THUMBNAIL_PREFIX + 'ab/cd/orphan.jpg'
+        for name in (alternative, orphan):
+            default.storage.save(name, ContentFile(b'image'))
+
+        # too new
+        self.assertEqual(sweep()['deleted'], 0)
+
+        out = StringIO('')
+        management.call_command('thumbnail', 'sweep', min_age=0, dry_run=True,
+                                verbosity=2, stdout=out)
+        self.assertIn('\n%s\n' % orphan, out.getvalue())
+        self.assertTrue(out.getvalue().endswith('1 files would be deleted\n'))
+        self.assertTrue(default.storage.exists(orphan))
+
+        workers = 1 if ThreadPoolExecutor is None else 2
+        stats = sweep(min_age=0, workers=workers, chunk_size=1, rate=1000)
+        self.assertEqual(stats['deleted'], 1)
+        self.assertFalse(default.storage.exists(orphan))
+        self.assertTrue(default.storage.exists(alternative))
+
+        # Everything in the storage would be swept
+        self.assertRaises(ThumbnailError, sweep, prefix='')
+        self.assertRaises(ThumbnailError, sweep, prefix='/')
+        self.assertTrue(th.exists())
+
+    def test_parse_spec(self):
+        self.assertEqual(parse_spec('100x100 crop="center" quality=70 upscale=False'),
+                         ('100x100', {'crop': 'center', 'quality': 70, 'upscale': False}))
+        self.assertEqual(parse_spec('100x100 crop="50% 50%" format=\'PNG\''),
+                         ('100x100', {'crop': '50% 50%', 'format': 'PNG'}))
+        self.assertRaises(ThumbnailError, parse_spec, '100x100 crop')
+        self.assertRaises(ThumbnailError, parse_spec, '100x100 =center')
+
+    def test_init_worker(self):
+        default.kvstore.get(ImageFile('missing.jpg'))
+        kvstore = default.kvstore._wrapped
+        init_worker()
+        self.assertTrue(default.kvstore._wrapped is empty)
+        # set up again when it is used
+        self.assertEqual(default.kvstore.get(ImageFile('missing.jpg')), None)
+        self.assertFalse(default.kvstore._wrapped is kvstore)
+
 
 class FakeFile(object):
     """